@@ -0,0 +1,136 @@
+"""
+CSC111 Final Project: Playlist Generator
+
+Module Description
+==================
+
+This file times the different ways of building our graphs against each other, and checks
+that they all make exactly the same edges. It also times answering "which songs are at
+depth d" queries with Graph.bfs against the sparse matrix engine (SparseQueryEngine), on
+randomly generated clusters.
+
+Run it from the project folder, e.g.
+    python benchmark.py --epsilon 0.05
+    python benchmark.py --depth-queries 500 --adventure 4
+
+
+Copyright and Usage Information
+===============================
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+This file is Copyright (c) 2021 Si Yuan Zhao, Hayk Nazaryan, Cliff Zhang, Joanne Pan.
+"""
+from __future__ import annotations
+import random
+import time
+from argparse import ArgumentParser
+from typing import List
+from Point import Point
+from post_cluster import Graph, NEIGHBOUR_SEARCHES, generate_random_points
+from k_means import load_path, initialize_data
+
+SAMPLE_PATH = 'DataGeneration Data/normalized_data_sample.csv'
+
+
+def benchmark_neighbour_searches(points: List[Point], epsilon: float,
+                                 searches: tuple = NEIGHBOUR_SEARCHES) -> dict:
+    """
+    Build a graph of copies of points with every neighbour search in searches and print
+    how long each took. Return a dictionary mapping each search to its build time in seconds.
+
+    Raise an AssertionError if any search makes different edges from the first one.
+    """
+    times = {}
+    expected_edges = None
+    for search in searches:
+        graph = Graph(points=[Point(list(point.pos), point.id) for point in points],
+                      epsilon=epsilon, neighbour_search=search)
+        start = time.perf_counter()
+        graph.init_edges()
+        times[search] = time.perf_counter() - start
+
+        edges = graph.edge_ids()
+        if expected_edges is None:
+            expected_edges = edges
+        assert edges == expected_edges, f'{search} made different edges'
+
+    print(f'{len(points)} points, epsilon={epsilon}, {len(expected_edges)} edges')
+    for search in searches:
+        print(f'{search:>10}: {times[search]:.3f}s')
+    return times
+
+
+def benchmark_depth_queries(dimension: int, num_points: int, epsilon: float,
+                            num_queries: int, adventure: int) -> dict:
+    """
+    Make a graph of num_points random points (see generate_random_points) in dimension
+    dimensions, and answer num_queries queries for the songs at depth=adventure from a random
+    song, once with Graph.bfs (one query at a time) and once with Graph.depth_songs (all
+    queries together). Print how long each took, and return a dictionary mapping 'bfs' and
+    'sparse' to their times in seconds.
+
+    Raise an AssertionError if the two disagree: Graph.bfs must find a song exactly when
+    depth_songs finds some, and the song it finds must be one of them.
+
+    Preconditions:
+        - dimension > 0 and num_points > 0 and epsilon > 0
+        - num_queries > 0 and adventure >= 0
+    """
+    graph = Graph(points=generate_random_points(dimension, num_points), epsilon=epsilon)
+    graph.init_edges()
+    queries = [(random.choice(graph.song_ids), adventure) for _ in range(num_queries)]
+
+    start = time.perf_counter()
+    bfs_results = [graph.bfs(song_id, depth, []) for song_id, depth in queries]
+    bfs_time = time.perf_counter() - start
+
+    graph.get_sparse_engine()   # Building the matrix is not part of answering queries
+    start = time.perf_counter()
+    depth_songs = graph.depth_songs(queries)
+    sparse_time = time.perf_counter() - start
+
+    for bfs_result, songs in zip(bfs_results, depth_songs):
+        assert bfs_result['success'] == (songs != []), 'bfs and depth_songs disagree'
+        assert not bfs_result['success'] or bfs_result['data'] in songs, \
+            'bfs found a song depth_songs did not'
+
+    print(f'{num_points} points, {graph.get_adjacency().num_edges()} edges, '
+          f'{num_queries} queries at adventure={adventure}')
+    print(f'{"bfs":>10}: {bfs_time:.3f}s')
+    print(f'{"sparse":>10}: {sparse_time:.3f}s')
+    return {'bfs': bfs_time, 'sparse': sparse_time}
+
+
+if __name__ == '__main__':
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--path', type=str, default=SAMPLE_PATH)
+    arg_parser.add_argument('--epsilon', type=float, default=0.05)
+    arg_parser.add_argument('--depth-queries', type=int, default=0)
+    arg_parser.add_argument('--adventure', type=int, default=4)
+    arg_parser.add_argument('--dimension', type=int, default=4)
+    arg_parser.add_argument('--num-points', type=int, default=3000)
+    arg_parser.add_argument('--random-epsilon', type=float, default=3.0)
+    args = arg_parser.parse_args()
+
+    if args.depth_queries > 0:
+        benchmark_depth_queries(args.dimension, args.num_points, args.random_epsilon,
+                                args.depth_queries, args.adventure)
+    else:
+        benchmark_neighbour_searches(initialize_data(load_path(args.path)), args.epsilon)
@@ -0,0 +1,545 @@
+"""
+CSC111 Final Project: Playlist Generator
+
+Module Description
+==================
+
+This file saves and opens our graphs as a graph artifact: a folder of raw numpy arrays that
+are memory-mapped when opened, so nothing has to be unpickled or recomputed at startup.
+
+A graph artifact folder holds:
+    - manifest.json: the format version, the number of dimensions of a position and, for each
+      cluster, its epsilon, k_nearest and mutual values
+    - centroids.npy: the position of each cluster's centroid, one row per cluster
+    - vertex_offsets.npy: the songs of cluster c are rows vertex_offsets[c] to
+      vertex_offsets[c + 1] (exclusive) of features.npy and ids.npy
+    - features.npy: the normalized position of every song, one row per song
+    - ids.npy: the id of every song
+    - offsets.npy, indices.npy, distances.npy: the edges of every song in compressed sparse
+      row form (see post_cluster.Adjacency); the neighbours of song i are
+      indices[offsets[i]:offsets[i + 1]], numbered within the song's own cluster
+
+Graphs are served by a GraphRegistry, which only keeps the centroids in memory and restores
+each cluster's Graph the first time it is used, keeping at most a few of them restored.
+
+Existing pickled graphs files (e.g. Graph_Final.pickle) can be converted with
+    python graph_artifact.py --input-graphs-file-name Graph_Final.pickle
+                             --output-artifact-name Graph_Final
+
+
+Copyright and Usage Information
+===============================
+
+Permission is hereby granted, free of charge, to any person
+obtaining a copy of this software and associated documentation
+files (the "Software"), to deal in the Software without
+restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the
+Software is furnished to do so, subject to the following
+conditions:
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES
+OF MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY,
+WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR
+OTHER DEALINGS IN THE SOFTWARE.
+
+This file is Copyright (c) 2021 Si Yuan Zhao, Hayk Nazaryan, Cliff Zhang, Joanne Pan.
+"""
+from __future__ import annotations
+import json
+import os
+import pickle
+from argparse import ArgumentParser
+from collections import OrderedDict
+from typing import Any, Iterator, List, Optional
+import numpy as np
+from Point import Point
+from k_means import nearest_centroids_ranked, save_atomically
+from post_cluster import Adjacency, Graph, Graph_Save
+
+# Bump whenever the layout of a graph artifact changes, so old artifacts are refused
+ARTIFACT_VERSION = 2
+
+# The arrays of a graph artifact, each saved as <name>.npy in the artifact folder
+ARTIFACT_ARRAYS = ('centroids', 'vertex_offsets', 'features', 'ids', 'offsets', 'indices',
+                   'distances')
+
+# The default number of restored graphs a GraphRegistry keeps in memory
+DEFAULT_MAX_RESIDENT_GRAPHS = 16
+
+
+class GraphArtifact:
+    """
+    An opened graph artifact. Its arrays are memory-mapped read-only, so opening it only
+    reads the manifest, and each graph is only read from disk when it is restored.
+
+    Instance Attributes:
+        - path: the artifact folder
+        - dimension: the number of dimensions of the position of a song or centroid
+        - clusters: for each cluster, a dictionary of its epsilon, k_nearest and mutual values
+        - centroids: float64 array of the position of each cluster's centroid
+        - vertex_offsets: int64 array; the songs of cluster c are vertex_offsets[c] to
+          vertex_offsets[c + 1] (exclusive)
+        - features: float64 array of the position of every song, one row per song
+        - ids: array of the id of every song
+        - offsets: int64 array of the CSR offsets of every song's edges
+        - indices: int32 array of the neighbours of every song, numbered within its cluster
+        - distances: float32 array of the distance to each neighbour in indices
+
+    Representation Invariants:
+        - len(self.clusters) == len(self.centroids) == len(self.vertex_offsets) - 1
+        - len(self.features) == len(self.ids) == len(self.offsets) - 1
+        - self.centroids.shape[1] == self.features.shape[1] == self.dimension
+    """
+
+    path: str
+    dimension: int
+    clusters: List[dict]
+    centroids: np.ndarray
+    vertex_offsets: np.ndarray
+    features: np.ndarray
+    ids: np.ndarray
+    offsets: np.ndarray
+    indices: np.ndarray
+    distances: np.ndarray
+
+    def __init__(self, path: str) -> None:
+        """
+        Open the graph artifact in the folder path
+
+        Raise a ValueError if it was written with a different ARTIFACT_VERSION.
+        """
+        with open(os.path.join(path, 'manifest.json')) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest['version'] != ARTIFACT_VERSION:
+            raise ValueError(f'{path} is a version {manifest["version"]} graph artifact, '
+                             f'expected version {ARTIFACT_VERSION}')
+
+        self.path = path
+        self.dimension = manifest['dimension']
+        self.clusters = manifest['clusters']
+        for name in ARTIFACT_ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+
+    def __len__(self) -> int:
+        """
+        Return the number of clusters
+        """
+        return len(self.clusters)
+
+    def centroid(self, c: int) -> Point:
+        """
+        Return the centroid of cluster c as a Point
+        """
+        return Point(self.centroids[c].tolist())
+
+    def arrays(self, c: int) -> tuple:
+        """
+        Return the cluster arrays (see write_cluster_arrays) of cluster c. Apart from the
+        offsets of the adjacency, they are views of the memory-mapped arrays, so nothing else
+        is read from disk until they are used.
+
+        Preconditions:
+            - 0 <= c < len(self)
+        """
+        start, end = int(self.vertex_offsets[c]), int(self.vertex_offsets[c + 1])
+        edge_start, edge_end = int(self.offsets[start]), int(self.offsets[end])
+        adjacency = Adjacency(np.array(self.offsets[start:end + 1]) - edge_start,
+                              self.indices[edge_start:edge_end],
+                              self.distances[edge_start:edge_end])
+        return self.features[start:end], self.ids[start:end], adjacency, self.clusters[c]
+
+    def restore(self, c: int) -> Graph:
+        """
+        Restore and return the Graph of cluster c.
+
+        The edges of the graph are views of the memory-mapped arrays rather than copies (only
+        its offsets are copied), so they are read from disk as the graph uses them.
+
+        Preconditions:
+            - 0 <= c < len(self)
+        """
+        positions, ids, adjacency, cluster = self.arrays(c)
+        points = [Point(pos, point_id) for pos, point_id in zip(positions.tolist(), ids.tolist())]
+        return Graph(points=points, epsilon=cluster['epsilon'], k_nearest=cluster['k_nearest'],
+                     mutual=cluster['mutual'], adjacency=adjacency)
+
+    def restore_all(self) -> dict:
+        """
+        Restore every graph, and return a dictionary mapping the centroid of each cluster to
+        its Graph (in the order of the clusters)
+        """
+        return {self.centroid(c): self.restore(c) for c in range(len(self))}
+
+
+class PickledGraphs:
+    """
+    The graphs of a pickled graphs file (a dictionary mapping centroid to Graph_Save, as
+    pickled by post_cluster.py), with the same interface as GraphArtifact for GraphRegistry.
+    Unlike a graph artifact, the whole file is read when it is opened.
+
+    Instance Attributes:
+        - centroids: the centroid of each cluster
+        - graph_saves: the Graph_Save of each cluster
+        - vertex_offsets: int64 array; the songs of cluster c are vertex_offsets[c] to
+          vertex_offsets[c + 1] (exclusive) of self.ids
+        - ids: array of the id of every song, cluster by cluster
+    """
+
+    centroids: list
+    graph_saves: list
+    vertex_offsets: np.ndarray
+    ids: np.ndarray
+
+    def __init__(self, graphs_file_name: str) -> None:
+        """
+        Open the pickled graphs file graphs_file_name
+        """
+        with open(graphs_file_name, 'rb') as graphs_file:
+            centroid_to_graph_save = pickle.load(file=graphs_file)
+        self.centroids = list(centroid_to_graph_save)
+        self.graph_saves = [centroid_to_graph_save[centroid] for centroid in self.centroids]
+        self.vertex_offsets = np.cumsum([0] + [len(graph_save.points)
+                                               for graph_save in self.graph_saves])
+        self.ids = np.array([point_id for graph_save in self.graph_saves
+                             for _, point_id in graph_save.points], dtype=str)
+
+    def __len__(self) -> int:
+        """
+        Return the number of clusters
+        """
+        return len(self.centroids)
+
+    def centroid(self, c: int) -> Point:
+        """
+        Return the centroid of cluster c
+        """
+        return self.centroids[c]
+
+    def arrays(self, c: int) -> tuple:
+        """
+        Return the cluster arrays (see write_cluster_arrays) of cluster c
+        """
+        return _graph_save_arrays(self.graph_saves[c], len(self.centroids[c].pos))
+
+    def restore(self, c: int) -> Graph:
+        """
+        Restore and return the Graph of cluster c
+        """
+        return self.graph_saves[c].restore()
+
+
+class GraphRegistry:
+    """
+    A dictionary-like mapping of centroid to Graph, for the graphs of a GraphArtifact or
+    PickledGraphs. Only the centroids are kept in memory up front: a cluster's Graph is
+    restored the first time it is looked up, and only the max_resident most recently used
+    graphs are kept.
+
+    A graph that gained songs (see Graph.init_new_point) is never dropped, since its new
+    songs are not saved anywhere else.
+
+    Which cluster each song is in is looked up in a hash index over every song id, built
+    once from the id table of the source and kept up to date as graphs gain songs.
+
+    Instance Attributes:
+        - source: the GraphArtifact or PickledGraphs the graphs are restored from
+        - max_resident: the most restored graphs (besides those that gained songs) to keep
+        - centroids: the centroid of each cluster
+        - centroid_index: a dictionary mapping each centroid to its cluster number
+        - centroid_matrix: float64 array of the positions of the centroids, one row each
+        - resident: the restored graphs kept, mapping cluster number to Graph, least recently
+          used first
+        - pinned: the restored graphs that gained songs, mapping cluster number to Graph
+        - song_index: a dictionary mapping each song id to the number of the first cluster
+          containing it
+
+    Representation Invariants:
+        - self.max_resident > 0
+        - len(self.resident) <= self.max_resident
+        - not any(c in self.pinned for c in self.resident)
+    """
+
+    source: Any
+    max_resident: int
+    centroids: List[Point]
+    centroid_index: dict
+    centroid_matrix: np.ndarray
+    resident: OrderedDict
+    pinned: dict
+    song_index: dict
+
+    def __init__(self, source: Any, max_resident: int = DEFAULT_MAX_RESIDENT_GRAPHS) -> None:
+        """
+        Initialize a GraphRegistry over the graphs of source, with none restored yet
+        """
+        self.source = source
+        self.max_resident = max_resident
+        self.centroids = [source.centroid(c) for c in range(len(source))]
+        self.centroid_index = {centroid: c for c, centroid in enumerate(self.centroids)}
+        self.centroid_matrix = np.array([centroid.pos for centroid in self.centroids],
+                                        dtype=np.float64)
+        self.resident = OrderedDict()
+        self.pinned = dict()
+
+        # Built from the last song to the first, so a song in several clusters keeps the first
+        song_clusters = np.repeat(np.arange(len(source)), np.diff(source.vertex_offsets))
+        self.song_index = dict(zip(source.ids[::-1].tolist(), song_clusters[::-1].tolist()))
+
+    def __len__(self) -> int:
+        """
+        Return the number of clusters
+        """
+        return len(self.centroids)
+
+    def __iter__(self) -> Iterator[Point]:
+        """
+        Iterate over the centroids, in the order of the clusters
+        """
+        return iter(self.centroids)
+
+    def __contains__(self, centroid: Any) -> bool:
+        """
+        Return whether centroid is the centroid of a cluster
+        """
+        return centroid in self.centroid_index
+
+    def keys(self) -> List[Point]:
+        """
+        Return the centroids, in the order of the clusters
+        """
+        return list(self.centroids)
+
+    def __getitem__(self, centroid: Point) -> Graph:
+        """
+        Return the Graph of the cluster of centroid, restoring it if it is not in memory
+        """
+        c = self.centroid_index[centroid]
+        if c in self.pinned:
+            return self.pinned[c]
+        if c in self.resident:
+            self.resident.move_to_end(c)
+            return self.resident[c]
+
+        graph = self.source.restore(c)
+        graph.on_new_point = lambda point: self.song_index.setdefault(point.id, c)
+        self.resident[c] = graph
+        while len(self.resident) > self.max_resident:
+            oldest, oldest_graph = self.resident.popitem(last=False)
+            if len(oldest_graph.points) != self._num_songs(oldest):
+                self.pinned[oldest] = oldest_graph
+        return graph
+
+    def find_song(self, song_id: str) -> Optional[Point]:
+        """
+        Return the centroid of the first cluster containing the song song_id, or None if no
+        cluster does. No graph is restored.
+        """
+        c = self.song_index.get(song_id)
+        return None if c is None else self.centroids[c]
+
+    def nearest_centroids(self, features: Any, m: int = 1) -> List[List[Point]]:
+        """
+        Return, for each row of features (the normalized positions of songs, one per row),
+        its m nearest centroids, nearest first. All rows are routed with one matrix product
+        against self.centroid_matrix.
+
+        Preconditions:
+            - all(len(row) == self.centroid_matrix.shape[1] for row in features)
+            - 0 < m <= len(self)
+        """
+        matrix = np.asarray(features, dtype=np.float64).reshape(-1, self.centroid_matrix.shape[1])
+        ranked = nearest_centroids_ranked(matrix, self.centroid_matrix, m)
+        return [[self.centroids[c] for c in row] for row in ranked.tolist()]
+
+    def arrays(self, c: int) -> tuple:
+        """
+        Return the cluster arrays (see write_cluster_arrays) of cluster c: taken from the
+        Graph if it gained songs, and otherwise straight from self.source, without restoring
+        the graph
+        """
+        graph = self.pinned.get(c)
+        if graph is None and c in self.resident \
+                and len(self.resident[c].points) != self._num_songs(c):
+            graph = self.resident[c]
+        if graph is None:
+            return self.source.arrays(c)
+        return _graph_arrays(graph, self.centroid_matrix.shape[1])
+
+    def _num_songs(self, c: int) -> int:
+        """
+        Return the number of songs of cluster c in self.source
+        """
+        return int(self.source.vertex_offsets[c + 1] - self.source.vertex_offsets[c])
+
+
+def write_graph_artifact(path: str, centroid_to_graph_save: dict) -> None:
+    """
+    Write the graphs of centroid_to_graph_save (a dictionary mapping centroid to Graph_Save,
+    as pickled by post_cluster.py) as a graph artifact in the folder path, creating the
+    folder if needed.
+
+    Preconditions:
+        - centroid_to_graph_save != {}
+        - all centroids (and songs) have the same number of dimensions
+    """
+    dimension = len(next(iter(centroid_to_graph_save)).pos)
+    write_cluster_arrays(path, list(centroid_to_graph_save),
+                         [_graph_save_arrays(graph_save, dimension)
+                          for graph_save in centroid_to_graph_save.values()])
+
+
+def write_cluster_arrays(path: str, centroids: List[Point], clusters: List[tuple]) -> None:
+    """
+    Write a graph artifact in the folder path, creating the folder if needed, of the clusters
+    with the given centroids. Each of clusters is the cluster arrays of a cluster: a tuple
+    (positions, ids, adjacency, values) of the (number of songs x dimension) array of the
+    positions of its songs, their ids, the Adjacency of its edges and a dictionary of its
+    epsilon, k_nearest and mutual values. A cluster may have no songs.
+
+    The files are built and written one at a time, so only one of them is in memory at once
+    (the arrays of clusters may be memory-mapped, and are then only read as needed).
+
+    The manifest is written last, so a folder whose writing was interrupted cannot be opened.
+    Each file is written to a new temporary file that is then swapped in (see
+    k_means.save_atomically), so a GraphArtifact that has the folder open keeps reading its
+    old arrays, and two processes saving to the same folder never write to the same file.
+
+    Preconditions:
+        - len(centroids) == len(clusters) > 0
+        - all centroids (and songs) have the same number of dimensions
+    """
+    os.makedirs(path, exist_ok=True)
+    manifest_path = os.path.join(path, 'manifest.json')
+    try:
+        os.remove(manifest_path)
+    except FileNotFoundError:
+        # A new folder, or another process saving to it removed the manifest first
+        pass
+
+    dimension = len(centroids[0].pos)
+    vertex_offsets = np.cumsum([0] + [len(positions) for positions, _, _, _ in clusters])
+    edge_offsets = np.cumsum([0] + [len(adjacency.indices) for _, _, adjacency, _ in clusters])
+    builders = {
+        'centroids': lambda: np.array([centroid.pos for centroid in centroids],
+                                      dtype=np.float64).reshape(-1, dimension),
+        'vertex_offsets': lambda: vertex_offsets.astype(np.int64),
+        'features': lambda: np.concatenate(
+            [np.zeros((0, dimension))] +
+            [np.asarray(positions, dtype=np.float64) for positions, _, _, _ in clusters]),
+        'ids': lambda: np.concatenate(
+            [np.zeros(0, dtype=str)] + [np.asarray(ids, dtype=str) for _, ids, _, _ in clusters]),
+        'offsets': lambda: np.concatenate(
+            [np.zeros(1, dtype=np.int64)] +
+            [adjacency.offsets[1:] + edge_offset
+             for (_, _, adjacency, _), edge_offset in zip(clusters, edge_offsets.tolist())]),
+        'indices': lambda: np.concatenate(
+            [np.zeros(0, dtype=np.int32)] +
+            [np.asarray(adjacency.indices, dtype=np.int32) for _, _, adjacency, _ in clusters]),
+        'distances': lambda: np.concatenate(
+            [np.zeros(0, dtype=np.float32)] +
+            [np.asarray(adjacency.distances, dtype=np.float32)
+             for _, _, adjacency, _ in clusters])
+    }
+    for name in ARTIFACT_ARRAYS:
+        save_atomically(os.path.join(path, name + '.npy'),
+                        lambda array_file, build=builders[name]: np.save(array_file, build()))
+
+    manifest = {'version': ARTIFACT_VERSION, 'dimension': dimension,
+                'clusters': [values for _, _, _, values in clusters]}
+    save_atomically(manifest_path,
+                    lambda manifest_file: manifest_file.write(json.dumps(manifest).encode()))
+
+
+def _graph_save_arrays(graph_save: Graph_Save, dimension: int) -> tuple:
+    """
+    Return the cluster arrays (see write_cluster_arrays) of graph_save, whose songs have
+    dimension dimensions
+    """
+    positions, adjacency = graph_save.arrays(dimension)
+    return (positions, [point_id for _, point_id in graph_save.points], adjacency,
+            {'epsilon': graph_save.epsilon,
+             'k_nearest': getattr(graph_save, 'k_nearest', None),
+             'mutual': getattr(graph_save, 'mutual', False)})
+
+
+def _graph_arrays(graph: Graph, dimension: int) -> tuple:
+    """
+    Return the cluster arrays (see write_cluster_arrays) of graph, whose songs have
+    dimension dimensions
+    """
+    positions = np.array([point.pos for point in graph.points],
+                         dtype=np.float64).reshape(len(graph.points), dimension)
+    return (positions, [point.id for point in graph.points], graph.get_adjacency(),
+            {'epsilon': graph.epsilon, 'k_nearest': graph.k_nearest, 'mutual': graph.mutual})
+
+
+def convert_graph_pickle(graphs_file_name: str, path: str) -> None:
+    """
+    Convert the pickled graphs file graphs_file_name (e.g. Graph_Final.pickle) to a graph
+    artifact in the folder path
+    """
+    with open(graphs_file_name, 'rb') as graphs_file:
+        centroid_to_graph_save = pickle.load(file=graphs_file)
+    write_graph_artifact(path, centroid_to_graph_save)
+
+
+def load_graphs(graphs_file_name: str,
+                max_resident: int = DEFAULT_MAX_RESIDENT_GRAPHS) -> GraphRegistry:
+    """
+    Return a GraphRegistry of the graphs saved at graphs_file_name, which is either a graph
+    artifact folder or a pickled graphs file, keeping at most max_resident graphs restored
+
+    Preconditions:
+        - max_resident > 0
+    """
+    if os.path.isdir(graphs_file_name):
+        return GraphRegistry(GraphArtifact(graphs_file_name), max_resident)
+    return GraphRegistry(PickledGraphs(graphs_file_name), max_resident)
+
+
+def save_graphs(centroid_to_graph: Any, path: str) -> None:
+    """
+    Save the graphs of centroid_to_graph (a dictionary or GraphRegistry mapping centroid to
+    Graph) as a graph artifact in the folder path.
+
+    For a GraphRegistry, only the graphs that gained songs are read from their Graph; the
+    arrays of every other cluster are copied straight from its source, without restoring
+    the graph.
+
+    Preconditions:
+        - len(centroid_to_graph) > 0
+    """
+    centroids = list(centroid_to_graph)
+    dimension = len(centroids[0].pos)
+    if isinstance(centroid_to_graph, GraphRegistry):
+        clusters = [centroid_to_graph.arrays(c) for c in range(len(centroids))]
+    else:
+        clusters = [_graph_arrays(centroid_to_graph[centroid], dimension)
+                    for centroid in centroids]
+    write_cluster_arrays(path, centroids, clusters)
+
+
+if __name__ == '__main__':
+    import python_ta
+    python_ta.check_all(config={
+        'extra-imports': ['json', 'os', 'pickle', 'argparse', 'collections', 'numpy', 'Point',
+                          'k_means', 'post_cluster'],
+        'allowed-io': ['GraphArtifact.__init__', 'PickledGraphs.__init__',
+                       'write_graph_artifact', 'convert_graph_pickle'],
+        # the names (strs) of functions that call print/open/input
+        'max-line-length': 100,
+        'disable': ['E1136']
+    })
+
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--input-graphs-file-name', type=str)
+    arg_parser.add_argument('--output-artifact-name', type=str)
+    args = arg_parser.parse_args()
+
+    convert_graph_pickle(args.input_graphs_file_name, args.output_artifact_name)
@@ -37,9 +37,19 @@ OTHER DEALINGS IN THE SOFTWARE.
 This file is Copyright (c) 2021 Si Yuan Zhao, Hayk Nazaryan, Cliff Zhang, Joanne Pan.
 """
 from __future__ import annotations
-from typing import List
+from typing import Callable, Iterator, List, Optional
 import random
 import csv
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+import multiprocessing
+import multiprocessing.pool
+from multiprocessing import shared_memory
+import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 from Point import Point
@@ -49,6 +59,30 @@ ATTRIBUTE_TO_INDEX = {'acousticness': 0, 'danceability': 1, 'energy': 2, 'durati
                       'loudness': 8, 'speechiness': 10, 'key': 11}
 COLOR_CHOICES = list(plt.cm.colors.cnames)
 
+# Number of rows compared against the centroids at once. Bounds the size of the
+# temporary (chunk_size x k) distance matrix built during each assignment step.
+DEFAULT_CHUNK_SIZE = 4096
+
+# Number of rows of the .csv file read into memory at once by MiniBatchKMeans
+DEFAULT_BATCH_SIZE = 10000
+
+# Version of the binary cache written by load_matrix, bumped whenever its layout changes
+CACHE_VERSION = 2
+
+# 'lloyd' compares every point with every centroid on each iteration. 'hamerly' keeps an
+# upper bound on each point's distance to its own centroid and a lower bound on its distance
+# to every other centroid, and only recomputes distances for points whose bounds overlap.
+ALGORITHMS = ('lloyd', 'hamerly')
+
+# 'random' seeds the centroids with random songs. 'k-means++' picks each next seed with
+# probability proportional to its squared distance from the closest seed picked so far.
+INITS = ('random', 'k-means++')
+
+# A point only skips its distance computations if its bounds are separated by more than
+# this margin, which is well above the rounding error of nearest_centroids. This keeps the
+# assignments of the 'hamerly' algorithm identical to those of 'lloyd'.
+BOUND_TOLERANCE = 1e-6
+
 
 class KMeansAlgo:
     """
@@ -60,28 +94,162 @@ class KMeansAlgo:
         - data: A list of Point objects that are used in the algorithm to form clusters
         - centroids: A list of Point objects that describe the centers of the cluster
         - cluster: A dictionary mapping a centroid to a list of Points in that cluster
+        - matrix: A contiguous (len(data) x dimensions) float matrix of the positions in data
+        - labels: An array mapping each row of matrix to the index of its centroid
+        - chunk_size: The number of rows of matrix assigned to centroids at once
+        - algorithm: The assignment algorithm used, one of ALGORITHMS
+        - centroid_matrix: The positions of the centroids used for the last assignment
+        - upper: For 'hamerly', an upper bound on each point's distance to its centroid
+        - lower: For 'hamerly', a lower bound on each point's distance to any other centroid
+        - skipped: The number of point-to-centroid distance computations skipped on each
+          assignment step (always 0 for 'lloyd')
+        - history: A dictionary of telemetry for each call to run_once, with the keys
+          'inertia', 'moved', 'max_shift' and 'seconds'
+        - workers: The number of processes the full assignment step is split across
+        - pool: If workers > 1, the pool of worker processes, otherwise None
+        - shared_blocks: If workers > 1, the shared memory blocks holding self.matrix and
+          the labels written by the workers, otherwise None
+        - _furthest_cache: The clusters, n and result of the last find_furthest_n_clusters
 
     Representation Invariants:
         - self.k > 0
         - len(self.centroids) > 0
+        - len(self.matrix) == len(self.data)
+        - self.chunk_size > 0
+        - self.algorithm in ALGORITHMS
+        - self.workers > 0
     """
 
     data: list
     centroids: list
     clusters: dict
-
-    def __init__(self, path: str, k: int) -> None:
+    matrix: np.ndarray
+    labels: np.ndarray
+    chunk_size: int
+    algorithm: str
+    centroid_matrix: Optional[np.ndarray]
+    upper: Optional[np.ndarray]
+    lower: Optional[np.ndarray]
+    skipped: List[int]
+    history: List[dict]
+    workers: int
+    pool: Optional[multiprocessing.pool.Pool]
+    shared_blocks: Optional[tuple]
+    _furthest_cache: tuple
+
+    def __init__(self, path: str, k: int, chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 algorithm: str = 'lloyd', init: str = 'random', workers: int = 1,
+                 centroids: Optional[List[Point]] = None) -> None:
         """
         Initializes the k_means object with k number of centroids that are picked randomly
-        from the data points. The initialization also does the first round of clustering based
-        on those centroids.
+        from the data points (see INITS for how they are picked). The initialization also does
+        the first round of clustering based on those centroids.
+
+        If centroids is given (for example the centroids of an earlier clustering, see
+        warm_start), those are used as the initial centroids instead, and k and init are
+        ignored.
+
+        If workers > 1, self.matrix is copied once into shared memory and every full
+        assignment step is split into workers disjoint row ranges, each labelled by a worker
+        process that reads the rows from and writes the labels to shared memory. Call close
+        to stop the workers and free the shared memory.
+
+        The file is read through load_matrix, so only the first load of a .csv file parses
+        it.
 
         Preconditions:
             - k > 0
             - path contains a file that is formatted correctly for the load_path function
+            - chunk_size > 0
+            - algorithm in ALGORITHMS
+            - init in INITS
+            - workers > 0
+            - centroids is None or len(centroids) > 0
         """
-        self.data = initialize_data(load_path(path))
-        self.centroids = [random.choice(self.data) for _ in range(k)]
+        ids, features = load_matrix(path)
+        self.matrix = np.array(features, dtype=np.float64)
+        self.data = [Point(pos, point_id) for pos, point_id in
+                     zip(self.matrix.tolist(), ids.tolist())]
+        self.labels = np.zeros(len(self.data), dtype=np.intp)
+        self.chunk_size = chunk_size
+        self.algorithm = algorithm
+        self.centroid_matrix = None
+        self.upper = None
+        self.lower = None
+        self.skipped = []
+        self.history = []
+        self.workers = workers
+        self.pool = None
+        self.shared_blocks = None
+        self._furthest_cache = (None, 0, [])
+        if workers > 1:
+            self._start_workers()
+
+        if centroids is not None:
+            self.centroids = list(dict.fromkeys(centroids))
+        elif init == 'k-means++':
+            self.centroids = [self.data[i] for i in kmeans_plus_plus(self.matrix, k)]
+        else:
+            # The same song may be picked more than once, keep only one copy of each centroid
+            self.centroids = list(dict.fromkeys(random.choice(self.data) for _ in range(k)))
+        self.clusters = self.update_clusters()
+
+    def _start_workers(self) -> None:
+        """
+        Move self.matrix into shared memory and start self.workers worker processes that
+        attach to it (and to a shared label array) once.
+        """
+        matrix_block = shared_memory.SharedMemory(create=True, size=max(self.matrix.nbytes, 1))
+        labels_block = shared_memory.SharedMemory(create=True, size=max(self.labels.nbytes, 1))
+        shared_matrix = np.ndarray(self.matrix.shape, dtype=np.float64, buffer=matrix_block.buf)
+        shared_matrix[:] = self.matrix
+        self.matrix = shared_matrix
+        self.shared_blocks = (matrix_block, labels_block)
+        self.pool = multiprocessing.Pool(self.workers, initializer=_attach_shared_memory,
+                                         initargs=(matrix_block.name, labels_block.name,
+                                                   self.matrix.shape))
+
+    def close(self) -> None:
+        """
+        Stop the worker processes and free the shared memory, keeping a private copy of
+        self.matrix. Does nothing if there are no workers.
+        """
+        if self.pool is None:
+            return
+        self.pool.close()
+        self.pool.join()
+        self.matrix = np.array(self.matrix)
+        for block in self.shared_blocks:
+            block.close()
+            block.unlink()
+        self.pool = None
+        self.shared_blocks = None
+
+    def _nearest_centroids(self, centroid_matrix: np.ndarray) -> np.ndarray:
+        """
+        Return the index of the closest centroid for every row of self.matrix, splitting the
+        rows across the worker processes if there are any.
+        """
+        if self.pool is None:
+            return nearest_centroids(self.matrix, centroid_matrix, self.chunk_size)
+
+        bounds = np.linspace(0, len(self.matrix), self.workers + 1).astype(int).tolist()
+        self.pool.map(_assign_shared_rows,
+                      [(start, stop, centroid_matrix, self.chunk_size)
+                       for start, stop in zip(bounds, bounds[1:]) if start < stop])
+        labels_block = self.shared_blocks[1]
+        return np.ndarray(len(self.matrix), dtype=np.intp, buffer=labels_block.buf).copy()
+
+    def set_centroids(self, positions: List[list]) -> None:
+        """
+        Replace the centroids with new Point objects at the given positions and sort every
+        point into the cluster of the new centroid it is closest to.
+
+        Preconditions:
+            - len(positions) > 0
+            - all(len(pos) == self.matrix.shape[1] for pos in positions)
+        """
+        self.centroids = [Point(list(pos)) for pos in positions]
         self.clusters = self.update_clusters()
 
     def run_n_times(self, n: int) -> None:
@@ -91,60 +259,164 @@ class KMeansAlgo:
         for _ in range(n):
             self.run_once()
 
-    def run_once(self) -> None:
+    def run_until_converged(self, tolerance: float = 1e-4, reassign_tolerance: float = 0.0,
+                            max_iterations: int = 100, verbose: bool = False) -> int:
+        """
+        Run the k_means algorithm until it converges, and return the number of iterations run.
+
+        The algorithm has converged once no centroid moved further than tolerance, or once
+        the fraction of points that changed cluster is at most reassign_tolerance. At most
+        max_iterations iterations are run. If verbose is True, the telemetry of each
+        iteration (see run_once) is printed.
+
+        Preconditions:
+            - tolerance >= 0
+            - 0 <= reassign_tolerance <= 1
+            - max_iterations > 0
+        """
+        for iteration in range(1, max_iterations + 1):
+            stats = self.run_once()
+            if verbose:
+                print(f'Iteration {iteration}: inertia={stats["inertia"]:.4f} '
+                      f'moved={stats["moved"]} max_shift={stats["max_shift"]:.6f} '
+                      f'time={stats["seconds"]:.3f}s')
+            if stats['max_shift'] <= tolerance or \
+                    stats['moved'] <= reassign_tolerance * len(self.data):
+                return iteration
+        return max_iterations
+
+    def run_once(self) -> dict:
         """
         Runs the k-means algorithm once. The algorithm first finds the new centers of the
         clusters and then updates the clusters themselves. The function stores the new clusters
         in it's attributes.
+
+        Returns (and appends to self.history) the telemetry of the iteration:
+            - 'inertia': The sum of squared distances from each point to its centroid
+            - 'moved': The number of points that changed cluster
+            - 'max_shift': The largest distance a centroid moved
+            - 'seconds': The wall time of the iteration
         """
+        start = time.perf_counter()
+        old_labels = self.labels.copy()
+        old_centroid_matrix = self.centroid_matrix
+
         self.centroids = self.find_new_centroids()
         self.clusters = self.update_clusters()
 
+        shifts = np.sqrt(((self.centroid_matrix - old_centroid_matrix) ** 2).sum(axis=1))
+        stats = {'inertia': inertia(self.matrix, self.labels, self.centroid_matrix,
+                                    self.chunk_size),
+                 'moved': int((self.labels != old_labels).sum()),
+                 'max_shift': float(shifts.max()),
+                 'seconds': time.perf_counter() - start}
+        self.history.append(stats)
+        return stats
+
     def update_clusters(self) -> dict:
         """
         Sorts every point in self.data into a cluster based on the centroid that the point
         is closest to. Returns a dictionary mapping each centroid to a list of points which
         represents the clusters.
         """
-        # initialize a dictionary mapping each current centroid to a empty list
-        clusters = dict((key, []) for key in self.centroids)
-
-        # Iterate through every data point and sort into a centroid based on distance
-        for i in range(len(self.data)):
-            point = self.data[i]
-            closest_center = self.centroids[0]
-            min_distances = point.distance_from(closest_center)
-
-            # Iterate through each centroid and check distance between centroid and point
-            # Closest centroid is saved in closest_center
-            for centroid in self.centroids:
-                curr_distance = point.distance_from(centroid)
-                if curr_distance < min_distances:
-                    min_distances = curr_distance
-                    closest_center = centroid
-
-            # Append current point to the cluster of the associated center
-            clusters[closest_center].append(point)
+        centroid_matrix = np.array([centroid.pos for centroid in self.centroids],
+                                   dtype=np.float64)
+        if self.algorithm == 'hamerly':
+            self._assign_hamerly(centroid_matrix)
+        else:
+            self.labels = self._nearest_centroids(centroid_matrix)
+            self.skipped.append(0)
+        self.centroid_matrix = centroid_matrix
+
+        return _group_by_label(self.centroids, self.data, self.labels)
+
+    def _assign_hamerly(self, centroid_matrix: np.ndarray) -> None:
+        """
+        Update self.labels for the given centroid positions using Hamerly's bounds.
 
-        return clusters
+        A point keeps its centroid without computing any distances if its upper bound is
+        below both its lower bound and half the distance from its centroid to the nearest
+        other centroid. Otherwise the upper bound is tightened, and only if the bounds still
+        overlap is the point compared with every centroid.
+        """
+        n, k = len(self.matrix), len(centroid_matrix)
+
+        if self.upper is None or self.centroid_matrix.shape != centroid_matrix.shape:
+            # No bounds yet (or the centroids changed), do a full assignment
+            self.labels = self._nearest_centroids(centroid_matrix)
+            self.upper, self.lower = _distance_bounds(self.matrix, self.labels,
+                                                      centroid_matrix, self.chunk_size)
+            self.skipped.append(0)
+            return
+
+        # Loosen the bounds by how far the centroids moved since the last assignment
+        shifts = np.sqrt(((centroid_matrix - self.centroid_matrix) ** 2).sum(axis=1))
+        self.upper += shifts[self.labels]
+        if k > 1:
+            order = np.argsort(shifts)
+            largest, second = shifts[order[-1]], shifts[order[-2]]
+            self.lower -= np.where(self.labels == order[-1], second, largest)
+
+        # Half the distance from each centroid to its closest other centroid
+        centroid_distances = np.sqrt(((centroid_matrix[:, None, :] -
+                                       centroid_matrix[None, :, :]) ** 2).sum(axis=2))
+        np.fill_diagonal(centroid_distances, np.inf)
+        bound = np.maximum(centroid_distances.min(axis=1)[self.labels] / 2, self.lower)
+
+        # Tighten the upper bound of the points whose bounds overlap
+        candidates = np.flatnonzero(self.upper + BOUND_TOLERANCE >= bound)
+        own = centroid_matrix[self.labels[candidates]]
+        self.upper[candidates] = np.sqrt(((self.matrix[candidates] - own) ** 2).sum(axis=1))
+        evaluated = len(candidates)
+
+        # Compare the points whose bounds still overlap with every centroid
+        candidates = candidates[self.upper[candidates] + BOUND_TOLERANCE >= bound[candidates]]
+        rows = self.matrix[candidates]
+        labels = nearest_centroids(rows, centroid_matrix, self.chunk_size)
+        self.labels[candidates] = labels
+        self.upper[candidates], self.lower[candidates] = _distance_bounds(
+            rows, labels, centroid_matrix, self.chunk_size)
+        evaluated += len(candidates) * k
+
+        self.skipped.append(n * k - evaluated)
 
     def find_new_centroids(self) -> List[Point]:
         """
         Returns the new centroids for each cluster based on the average of the attributes of the
         points in each cluster. The new centroids are returned as a list of Point objects.
+        If a cluster is empty, its original centroid is kept.
         """
+        sums, counts = sum_by_label(self.matrix, self.labels, len(self.centroids))
         new_centroids = []
 
-        # Iterate through the clusters and update each center
-        for centroid in self.clusters:
-
-            # Helper function finds the new center for each individual cluster
-            new = _update_centroid(centroid, self.clusters[centroid])
-            new_centroids.append(new)
+        for i, centroid in enumerate(self.centroids):
+            if counts[i] == 0:
+                # If the cluster is empty, keep the original centroid
+                new_centroids.append(centroid)
+            else:
+                # Otherwise, the new centroid is the average of the points in the cluster
+                new_centroids.append(Point((sums[i] / counts[i]).tolist()))
 
         # returns a list of the new centroids which will be used to update the clusters
         return new_centroids
 
+    def changed_clusters(self, old_clusters: dict) -> List[int]:
+        """
+        Returns the indices (into self.centroids) of the clusters whose songs differ from
+        the songs of the cluster at the same position in old_clusters, a clustering whose
+        centroids were used to initialize this object.
+
+        Preconditions:
+            - len(old_clusters) == len(self.centroids)
+        """
+        changed = []
+        for i, old_cluster in enumerate(old_clusters.values()):
+            old_ids = {point.id for point in old_cluster}
+            new_ids = {point.id for point in self.clusters[self.centroids[i]]}
+            if old_ids != new_ids:
+                changed.append(i)
+        return changed
+
     def print_cluster_len(self) -> None:
         """
         Print the lengths of each cluster in self.cluster
@@ -283,60 +555,393 @@ class KMeansAlgo:
 
     def find_furthest_n_clusters(self, n: int) -> list:
         """
-        Returns a list of clusters that are far away from each other
+        Returns a list of n clusters (or every cluster, if there are fewer than n) that are far
+        away from each other.
+
+        The two furthest centroids are picked first, then the centroid furthest from all
+        those picked so far is added until there are n. The result is cached until
+        self.clusters is replaced.
         """
+        cached_clusters, cached_n, cached_result = self._furthest_cache
+        if cached_clusters is self.clusters and cached_n == n:
+            return list(cached_result)
+
         centroids = list(self.clusters)
+        positions = np.array([centroid.pos for centroid in centroids], dtype=np.float64)
+        distances = np.sqrt(((positions[:, None, :] - positions[None, :, :]) ** 2).sum(axis=2))
+        chosen = _farthest_point_order(distances, n)
+
+        result = [centroids[i] for i in chosen]
+        self._furthest_cache = (self.clusters, n, result)
+        return list(result)
 
-        # Find the distances of every unique pair of centroids and store in list as tuple
-        # with values as distance, centroid1, centroid2
-        distances = [(centroids[i].distance_from(centroids[j]), centroids[i], centroids[j])
-                     for i in range(len(centroids))
-                     for j in range(i, len(centroids))
-                     if centroids[i] != centroids[j]]
 
-        # Sorted distances so that the furthest 2 distances are closest
-        distances.sort(reverse=True)
+def warm_start(path: str, clusters_file_name: str, algorithm: str = 'hamerly',
+               tolerance: float = 1e-4, max_iterations: int = 100) -> tuple:
+    """
+    Recluster the (possibly grown) file at path starting from the centroids of the
+    clusters pickled in clusters_file_name (a mapping of centroid to list of Points, like
+    Cluster_Final.pickle), and run until the clusters converge again.
 
-        result = set()
+    Returns a tuple (k_means, changed) where changed is the list of indices of the clusters
+    whose songs changed (see KMeansAlgo.changed_clusters), so that only the graphs of those
+    clusters need to be rebuilt.
 
-        i = 0
+    Preconditions:
+        - clusters_file_name is a pickle file of a non-empty dict mapping Point to list of Point
+        - algorithm in ALGORITHMS
+    """
+    old_clusters = load_clusters(clusters_file_name)
+    k_means = KMeansAlgo(path, len(old_clusters), algorithm=algorithm,
+                         centroids=list(old_clusters))
+    k_means.run_until_converged(tolerance=tolerance, max_iterations=max_iterations)
+    return k_means, k_means.changed_clusters(old_clusters)
 
-        # Take the first n values and put the centroids in a list
-        while len(result) < n:
-            result.add(distances[i][1])
-            result.add(distances[i][2])
-            i += 1
 
-        # Return the result as a list of centroids
-        return list(result)
+def run_restarts(path: str, k: int, n_restarts: int, workers: Optional[int] = None,
+                 init: str = 'k-means++', algorithm: str = 'lloyd', tolerance: float = 1e-4,
+                 max_iterations: int = 100) -> KMeansAlgo:
+    """
+    Run n_restarts independent k-means clusterings of the file at path in a pool of workers
+    processes (one per CPU if workers is None), each until it converges. Returns a
+    KMeansAlgo holding the clusters of the restart with the lowest inertia.
+
+    Preconditions:
+        - k > 0
+        - n_restarts > 0
+        - workers is None or workers > 0
+        - init in INITS
+        - algorithm in ALGORITHMS
+    """
+    # Build the cache of the file once, rather than in every worker at the same time
+    load_matrix(path)
+    jobs = [(path, k, random.randrange(2 ** 32), init, algorithm, tolerance, max_iterations)
+            for _ in range(n_restarts)]
+    with multiprocessing.Pool(workers) as pool:
+        results = pool.map(_run_restart, jobs)
+
+    _, best_positions = min(results, key=lambda result: result[0])
+    k_means = KMeansAlgo(path, k, algorithm=algorithm)
+    k_means.set_centroids(best_positions)
+    return k_means
+
+
+# The shared memory attached to by a worker process of KMeansAlgo
+_SHARED_MEMORY = {}
+
+
+def _attach_shared_memory(matrix_name: str, labels_name: str, shape: tuple) -> None:
+    """
+    Helper function for KMeansAlgo._start_workers, run once in each worker process.
+    Attach to the shared matrix and label arrays created by the parent process.
+    """
+    matrix_block = shared_memory.SharedMemory(name=matrix_name)
+    labels_block = shared_memory.SharedMemory(name=labels_name)
+    _SHARED_MEMORY['blocks'] = (matrix_block, labels_block)
+    _SHARED_MEMORY['matrix'] = np.ndarray(shape, dtype=np.float64, buffer=matrix_block.buf)
+    _SHARED_MEMORY['labels'] = np.ndarray(shape[0], dtype=np.intp, buffer=labels_block.buf)
+
+
+def _assign_shared_rows(job: tuple) -> None:
+    """
+    Helper function for KMeansAlgo._nearest_centroids, run in a worker process.
+    Write the labels of the shared matrix rows in [start, stop) to the shared label array.
+    """
+    start, stop, centroid_matrix, chunk_size = job
+    _SHARED_MEMORY['labels'][start:stop] = nearest_centroids(
+        _SHARED_MEMORY['matrix'][start:stop], centroid_matrix, chunk_size)
+
+
+def _run_restart(job: tuple) -> tuple:
+    """
+    Helper function for run_restarts, run in a worker process.
+    Returns a tuple (inertia, centroid positions) of a single converged clustering.
+    """
+    path, k, seed, init, algorithm, tolerance, max_iterations = job
+    random.seed(seed)
+    k_means = KMeansAlgo(path, k, algorithm=algorithm, init=init)
+    k_means.run_until_converged(tolerance=tolerance, max_iterations=max_iterations)
+    return k_means.history[-1]['inertia'], k_means.centroid_matrix.tolist()
 
 
-def _update_centroid(centroid: Point, points: list) -> Point:
+class MiniBatchKMeans:
     """
-    Helper function for KMeansAlgo.find_new_centroids.
-    Returns the new center of the cluster associated with the given centroid. If the
-    cluster is empty, then the original centroid is returned. Otherwise, a new Point object
-    is created with the position of the new center is returned.
+    Mini-batch k-means over a .csv file that is streamed batch_size rows at a time, so that
+    memory use depends on batch_size and k rather than on the size of the file.
+
+    Each batch is assigned to the nearest centroids, and every centroid is then moved to the
+    running mean of all points ever assigned to it (a per-centroid learning rate of
+    1 / count). Unlike KMeansAlgo, no Point objects are created.
+
+    Attributes:
+        - path: The path of the .csv file, formatted as for the load_path function
+        - batch_size: The number of rows read and assigned at once
+        - centroid_matrix: A (k x dimensions) float matrix of the centroid positions
+        - counts: The number of points assigned to each centroid so far
+        - chunk_size: The number of rows of a batch assigned to centroids at once
+
+    Representation Invariants:
+        - self.batch_size > 0
+        - len(self.counts) == len(self.centroid_matrix)
     """
 
-    if len(points) == 0:
-        # If the length of the associated cluster is 0, return original centroid
-        return centroid
-    else:
-        # If length of associated cluster is > 0, find new centroid
-        new_pos = []
-        dimensions = len(centroid.pos)
+    path: str
+    batch_size: int
+    centroid_matrix: np.ndarray
+    counts: np.ndarray
+    chunk_size: int
+
+    def __init__(self, path: str, k: int, batch_size: int = DEFAULT_BATCH_SIZE,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+        """
+        Initializes the centroids with k distinct rows picked randomly from the first batch
+        of the file.
+
+        Preconditions:
+            - 0 < k <= batch_size
+            - path contains a file that is formatted correctly for the load_path function
+            - the file has at least k rows
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
 
-        # Iterate through each attribute of the clusters and find the average
-        for i in range(dimensions):
-            accumulator = 0
-            for point in points:
-                accumulator += point.pos[i]
-            # Append the average to the pos value of new centroid
-            new_pos.append(accumulator / len(points))
+        _, first_batch = next(load_path_batches(path, batch_size))
+        seeds = random.sample(range(len(first_batch)), k)
+        self.centroid_matrix = first_batch[seeds].copy()
+        self.counts = np.zeros(k, dtype=np.int64)
 
-        # Return point object with pos of new centroid
-        return Point(new_pos)
+    def run(self, epochs: int = 1) -> None:
+        """
+        Stream the whole file epochs times, updating the centroids after every batch.
+        """
+        for _ in range(epochs):
+            for _, batch in load_path_batches(self.path, self.batch_size):
+                self.partial_fit(batch)
+
+    def partial_fit(self, batch: np.ndarray) -> None:
+        """
+        Assign a batch of points to their nearest centroids and move each centroid to the
+        running mean of every point assigned to it so far.
+
+        Preconditions:
+            - batch.shape[1] == self.centroid_matrix.shape[1]
+        """
+        labels = nearest_centroids(batch, self.centroid_matrix, self.chunk_size)
+        sums, counts = sum_by_label(batch, labels, len(self.centroid_matrix))
+        self.counts += counts
+        moved = counts > 0
+        self.centroid_matrix[moved] += (sums[moved] - counts[moved, None] *
+                                        self.centroid_matrix[moved]) / self.counts[moved, None]
+
+    def write_labels(self, output_path: str) -> None:
+        """
+        Stream the file once more and write a .csv file at output_path with the columns
+        id and cluster, where cluster is the index of the centroid the song is closest to.
+        """
+        with open(output_path, 'w', newline='') as output_file:
+            writer = csv.writer(output_file)
+            writer.writerow(['id', 'cluster'])
+            for ids, batch in load_path_batches(self.path, self.batch_size):
+                labels = nearest_centroids(batch, self.centroid_matrix, self.chunk_size)
+                writer.writerows(zip(ids, labels.tolist()))
+
+    def get_centroids(self) -> List[Point]:
+        """
+        Returns the centroids as a list of Point objects.
+        """
+        return [Point(pos) for pos in self.centroid_matrix.tolist()]
+
+
+def _farthest_point_order(distances: np.ndarray, n: int) -> List[int]:
+    """
+    Helper function for KMeansAlgo.find_furthest_n_clusters.
+    Returns min(n, len(distances)) indices chosen greedily from the square distance matrix
+    distances: first the two indices furthest apart, then repeatedly the index whose
+    distance to the closest chosen index is the largest.
+
+    Preconditions:
+        - distances is a symmetric matrix with a zero diagonal
+    """
+    n = min(n, len(distances))
+    if n <= 0:
+        return []
+    if len(distances) == 1:
+        return [0]
+
+    first, second = np.unravel_index(int(distances.argmax()), distances.shape)
+    chosen = [int(first), int(second)][:n]
+    closest = np.minimum(distances[first], distances[second])
+
+    while len(chosen) < n:
+        closest[chosen] = -1
+        furthest = int(closest.argmax())
+        chosen.append(furthest)
+        np.minimum(closest, distances[furthest], out=closest)
+
+    return chosen
+
+
+def nearest_centroids(matrix: np.ndarray, centroid_matrix: np.ndarray,
+                      chunk_size: int = DEFAULT_CHUNK_SIZE) -> np.ndarray:
+    """
+    Returns an array holding, for each row of matrix, the index of the closest row of
+    centroid_matrix. Ties are broken in favour of the lower index.
+
+    The rows are processed chunk_size at a time, so at most a (chunk_size x k) block of
+    distances is held in memory. The squared distance is expanded as
+    ||c||^2 - 2 x.c (the ||x||^2 term is the same for every centroid) so each chunk is a
+    single matrix product.
+
+    Preconditions:
+        - matrix.shape[1] == centroid_matrix.shape[1]
+        - len(centroid_matrix) > 0
+        - chunk_size > 0
+    """
+    labels = np.empty(len(matrix), dtype=np.intp)
+    centroid_norms = np.einsum('ij,ij->i', centroid_matrix, centroid_matrix)
+
+    for start in range(0, len(matrix), chunk_size):
+        chunk = matrix[start:start + chunk_size]
+        distances = centroid_norms - 2 * (chunk @ centroid_matrix.T)
+        labels[start:start + chunk_size] = distances.argmin(axis=1)
+
+    return labels
+
+
+def nearest_centroids_ranked(matrix: np.ndarray, centroid_matrix: np.ndarray, m: int,
+                             chunk_size: int = DEFAULT_CHUNK_SIZE) -> np.ndarray:
+    """
+    Returns an array of shape (len(matrix), m) holding, for each row of matrix, the indices
+    of its m closest rows of centroid_matrix, closest first. Ties are broken in favour of the
+    lower index, so the first column is nearest_centroids(matrix, centroid_matrix).
+
+    Distances are expanded and chunked as in nearest_centroids.
+
+    Preconditions:
+        - matrix.shape[1] == centroid_matrix.shape[1]
+        - 0 < m <= len(centroid_matrix)
+        - chunk_size > 0
+    """
+    ranked = np.empty((len(matrix), m), dtype=np.intp)
+    centroid_norms = np.einsum('ij,ij->i', centroid_matrix, centroid_matrix)
+
+    for start in range(0, len(matrix), chunk_size):
+        chunk = matrix[start:start + chunk_size]
+        distances = centroid_norms - 2 * (chunk @ centroid_matrix.T)
+        ranked[start:start + chunk_size] = np.argsort(distances, axis=1, kind='stable')[:, :m]
+
+    return ranked
+
+
+def kmeans_plus_plus(matrix: np.ndarray, k: int) -> List[int]:
+    """
+    Returns the indices of k rows of matrix picked with k-means++ seeding: the first row is
+    picked uniformly at random, and every next row with probability proportional to its
+    squared distance from the closest row picked so far. A row is never picked twice
+    unless matrix has fewer than k distinct rows.
+
+    Preconditions:
+        - 0 < k <= len(matrix)
+    """
+    chosen = [random.randrange(len(matrix))]
+    closest = ((matrix - matrix[chosen[0]]) ** 2).sum(axis=1)
+
+    for _ in range(k - 1):
+        cumulative = np.cumsum(closest)
+        if cumulative[-1] == 0:
+            # Every remaining row duplicates a picked one
+            chosen.append(random.randrange(len(matrix)))
+        else:
+            pick = int(np.searchsorted(cumulative, random.random() * cumulative[-1],
+                                       side='right'))
+            chosen.append(min(pick, len(matrix) - 1))
+        np.minimum(closest, ((matrix - matrix[chosen[-1]]) ** 2).sum(axis=1), out=closest)
+
+    return chosen
+
+
+def inertia(matrix: np.ndarray, labels: np.ndarray, centroid_matrix: np.ndarray,
+            chunk_size: int = DEFAULT_CHUNK_SIZE) -> float:
+    """
+    Returns the sum of the squared distances from each row of matrix to the centroid
+    given by its label.
+
+    Preconditions:
+        - len(matrix) == len(labels)
+        - all(0 <= label < len(centroid_matrix) for label in labels)
+        - chunk_size > 0
+    """
+    total = 0.0
+    for start in range(0, len(matrix), chunk_size):
+        chunk = matrix[start:start + chunk_size]
+        total += float(((chunk - centroid_matrix[labels[start:start + chunk_size]]) ** 2).sum())
+    return total
+
+
+def _distance_bounds(matrix: np.ndarray, labels: np.ndarray, centroid_matrix: np.ndarray,
+                     chunk_size: int = DEFAULT_CHUNK_SIZE) -> tuple:
+    """
+    Helper function for KMeansAlgo._assign_hamerly.
+    Returns a tuple (upper, lower) of arrays where upper[i] is the distance from row i of
+    matrix to the centroid labels[i], and lower[i] is the distance from row i to the closest
+    other centroid (infinity if there is only one centroid).
+
+    The distances are computed from the differences directly rather than by expanding the
+    square, so they are exact enough to be used as bounds.
+
+    Preconditions:
+        - len(matrix) == len(labels)
+        - all(0 <= label < len(centroid_matrix) for label in labels)
+        - chunk_size > 0
+    """
+    upper = np.empty(len(matrix), dtype=np.float64)
+    lower = np.empty(len(matrix), dtype=np.float64)
+
+    for start in range(0, len(matrix), chunk_size):
+        chunk = matrix[start:start + chunk_size]
+        chunk_labels = labels[start:start + chunk_size]
+        rows = np.arange(len(chunk))
+        distances = np.sqrt(((chunk[:, None, :] - centroid_matrix[None, :, :]) ** 2).sum(axis=2))
+        upper[start:start + chunk_size] = distances[rows, chunk_labels]
+        distances[rows, chunk_labels] = np.inf
+        lower[start:start + chunk_size] = distances.min(axis=1)
+
+    return upper, lower
+
+
+def _group_by_label(centroids: list, points: list, labels: np.ndarray) -> dict:
+    """
+    Helper function for KMeansAlgo.update_clusters.
+    Returns a dictionary mapping each centroid to the list of points whose label is the
+    index of that centroid. Points keep their relative order, and every centroid is a key
+    even if its cluster is empty.
+
+    Preconditions:
+        - len(points) == len(labels)
+        - all(0 <= label < len(centroids) for label in labels)
+    """
+    clusters = dict((key, []) for key in centroids)
+    for point, label in zip(points, labels.tolist()):
+        clusters[centroids[label]].append(point)
+    return clusters
+
+
+def sum_by_label(matrix: np.ndarray, labels: np.ndarray, k: int) -> tuple:
+    """
+    Returns a tuple (sums, counts) where sums[i] is the sum of the rows of matrix with
+    label i and counts[i] is the number of those rows. Every label is handled in a single
+    grouped pass over the matrix (one np.bincount per dimension).
+
+    Preconditions:
+        - len(matrix) == len(labels)
+        - all(0 <= label < k for label in labels)
+    """
+    counts = np.bincount(labels, minlength=k)
+    sums = np.empty((k, matrix.shape[1]), dtype=np.float64)
+    for dim in range(matrix.shape[1]):
+        sums[:, dim] = np.bincount(labels, weights=matrix[:, dim], minlength=k)
+    return sums, counts
 
 
 def load_path(path: str) -> List[List]:
@@ -364,6 +969,120 @@ def load_path(path: str) -> List[List]:
     return accumulator
 
 
+def load_matrix(path: str) -> tuple:
+    """
+    Loads the .csv file at path (formatted as for the load_path function) and returns a
+    tuple (ids, features) where ids is an array of the song ids and features is a
+    (len(ids) x dimensions) float64 matrix of their positions, holding exactly the values
+    load_path parses.
+
+    The first load converts the .csv file into a binary cache next to it (path + '.ids.npy',
+    path + '.features.npy' and path + '.meta.json'). Later loads memory-map the cache
+    instead of parsing the .csv file. The cache is rebuilt if the .csv file's contents
+    changed: its modification time and size are checked first, and its hash only if those
+    differ (e.g. after a copy).
+
+    Preconditions:
+        - The .csv file stored at path is formatted as for the load_path function
+    """
+    ids_path, features_path, meta_path = (path + '.ids.npy', path + '.features.npy',
+                                          path + '.meta.json')
+    stat = os.stat(path)
+
+    if os.path.exists(meta_path):
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        is_valid = meta.get('version') == CACHE_VERSION and \
+            meta['mtime_ns'] == stat.st_mtime_ns and meta['size'] == stat.st_size
+        if not is_valid and meta.get('version') == CACHE_VERSION and \
+                meta['sha1'] == _file_sha1(path):
+            # Same contents with a new modification time, just update the stamp
+            meta['mtime_ns'], meta['size'] = stat.st_mtime_ns, stat.st_size
+            save_atomically(meta_path, lambda meta_file: meta_file.write(
+                json.dumps(meta).encode()))
+            is_valid = True
+        if is_valid:
+            return np.load(ids_path, mmap_mode='r'), np.load(features_path, mmap_mode='r')
+
+    data = load_path(path)
+    ids = np.array([line[0] for line in data], dtype=str)
+    features = np.array([line[1:] for line in data], dtype=np.float64)
+    # Write to new files and swap them in, so arrays still mapped from an older cache stay valid
+    save_atomically(ids_path, lambda ids_file: np.save(ids_file, ids))
+    save_atomically(features_path, lambda features_file: np.save(features_file, features))
+
+    # The metadata is written last so an interrupted conversion is never used
+    meta = {'version': CACHE_VERSION, 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size,
+            'sha1': _file_sha1(path)}
+    save_atomically(meta_path, lambda meta_file: meta_file.write(json.dumps(meta).encode()))
+    return np.load(ids_path, mmap_mode='r'), np.load(features_path, mmap_mode='r')
+
+
+def save_atomically(path: str, save: Callable) -> None:
+    """
+    Calls save with a new temporary file (opened for binary writing) in the folder of path,
+    then moves that file to path. Every writer gets its own temporary file, so processes
+    building the same cache at once never write to the same file, and a reader only ever
+    sees a complete file at path. (Used by load_matrix and graph_artifact.py.)
+    """
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                                  suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'wb') as temp_file:
+            save(temp_file)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def _file_sha1(path: str) -> str:
+    """
+    Helper function for load_matrix.
+    Returns the SHA-1 hex digest of the file at path.
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_path_batches(path: str, batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[tuple]:
+    """
+    Lazily loads the .csv file at path, batch_size rows at a time. Yields tuples
+    (ids, matrix) where ids is the list of song ids of the rows and matrix is a
+    (len(ids) x dimensions) float matrix of their positions.
+
+    Preconditions:
+        - The .csv file stored at path is formatted as for the load_path function
+        - batch_size > 0
+    """
+    with open(path) as csv_file:
+        file = csv.reader(csv_file)
+        next(file)
+        ids, rows = [], []
+
+        for line in file:
+            ids.append(line[0])
+            rows.append([float(val) for val in line[1:]])
+            if len(rows) == batch_size:
+                yield ids, np.array(rows, dtype=np.float64)
+                ids, rows = [], []
+
+        if rows:
+            yield ids, np.array(rows, dtype=np.float64)
+
+
+def load_clusters(file_name: str) -> dict:
+    """
+    Loads and returns the clusters (a dictionary mapping centroid to list of Points) pickled
+    at file_name, as saved from KMeansAlgo.get_clusters.
+    """
+    with open(file_name, 'rb') as clusters_file:
+        return pickle.load(file=clusters_file)
+
+
 def initialize_data(data: List[List]) -> List[Point]:
     """
     Given a list of lists in the appropriate format, returns a list of Point objects.
@@ -378,10 +1097,15 @@ def initialize_data(data: List[List]) -> List[Point]:
 if __name__ == "__main__":
     import python_ta
     python_ta.check_all(config={
+        # the names (strs) of imported modules
         'extra-imports': ['__future', 'typing', 'matplotlib.pyplot', 'mpl_toolkits.mplot3d',
-                          'Point', 'random', 'csv'],  # the names (strs) of imported modules
-        'allowed-io': ['print_cluster_len', 'load_path'],  # the names (strs) of functions that
-        # call print/open/input
+                          'Point', 'random', 'csv', 'numpy', 'time', 'multiprocessing',
+                          'multiprocessing.pool', 'pickle', 'hashlib', 'json', 'os',
+                          'tempfile'],
+        # the names (strs) of functions that call print/open/input
+        'allowed-io': ['print_cluster_len', 'load_path', 'run_until_converged',
+                       'load_path_batches', 'write_labels', 'load_clusters', 'load_matrix',
+                       '_file_sha1'],
         'max-line-length': 100,
         'disable': ['E1136']
     })
@@ -40,7 +40,7 @@ if __name__ == '__main__':
     python_ta.check_all(config={
         'extra-imports': ['pickle', 'tkinter', 'PIL', 'urllib', 'webbrowser',
                           'Recommendation', 'k_means', 'spotipy', 'argparse', 'song_tkinter',
-                          'preprocess', 'post_cluster'],
+                          'preprocess', 'post_cluster', 'graph_artifact'],
         'allowed-io': [],
         # the names (strs) of functions that call print/open/input
         'max-line-length': 100,
@@ -49,12 +49,11 @@ if __name__ == '__main__':
 
     from argparse import ArgumentParser
     import tkinter as tk
-    import pickle
     import spotipy
 
     from song_tkinter import UserPlaylistEntry, NewPlaylistOutput
     from preprocess import Data
-    from post_cluster import Graph_Save
+    from graph_artifact import load_graphs, DEFAULT_MAX_RESIDENT_GRAPHS
 
     print('Running main.py. Tkinter interface will appear', end=' ')
     print('when everything finishes loading.\n', end='\r')
@@ -62,6 +61,7 @@ if __name__ == '__main__':
     print('Parsing args...', end='\r')
     arg_parser = ArgumentParser()
     arg_parser.add_argument('--graphs-file-name', type=str)
+    arg_parser.add_argument('--max-resident-graphs', type=int, default=DEFAULT_MAX_RESIDENT_GRAPHS)
     args = arg_parser.parse_args()
     print('Done parsing args!\n', end='\r')
 
@@ -77,16 +77,12 @@ if __name__ == '__main__':
     sp = spotipy.Spotify(client_credentials_manager=credentials_manager)
     print('Done initializing Spotipy client!\n', end='\r')
 
-    # Restore centroid_to_graph
-    print('Restoring Graphs... This will take a while (3 - 10 min).', end='\r')
-    graphs_file = open(args.graphs_file_name, 'rb')
-    centroid_to_graph_save = pickle.load(file=graphs_file)
-    centroid_to_graph = dict()
-    for centroid in centroid_to_graph_save:
-        cur_graph_save = centroid_to_graph_save[centroid]
-        restored_graph = cur_graph_save.restore()
-        centroid_to_graph[centroid] = restored_graph
-    print('Done restoring Graphs!                                  \n', end='\r')
+    # Open centroid_to_graph
+    # Each Graph is only restored when first used. A graph artifact (see graph_artifact.py)
+    # opens at once, a pickled graphs file takes a while to read.
+    print('Opening Graphs...', end='\r')
+    centroid_to_graph = load_graphs(args.graphs_file_name, args.max_resident_graphs)
+    print('Done opening Graphs!\n', end='\r')
 
     # Show tkinter
     print('Starting Tkinter interface.\n', end='\r')
@@ -1,12 +1,10 @@
 from argparse import ArgumentParser
-import pickle
 
 # from Spotify.song_ids import get_song_ids
 # from Spotify.song_features import get_features
 from spotify_client import Spotify_Client
-from post_cluster import Graph_Save
+from graph_artifact import load_graphs, save_graphs, DEFAULT_MAX_RESIDENT_GRAPHS
 from preprocess import Data
-from Point import Point
 
 import spotipy
 
@@ -20,6 +18,7 @@ if __name__ == '__main__':
     arg_parser.add_argument('--playlist-link', type=str)
     arg_parser.add_argument('--adventure', type=int)
     arg_parser.add_argument('--graphs-file-name', type=str)
+    arg_parser.add_argument('--max-resident-graphs', type=int, default=DEFAULT_MAX_RESIDENT_GRAPHS)
     args = arg_parser.parse_args()
     print('Done parsing args!\n', end='\r')
 
@@ -36,15 +35,10 @@ if __name__ == '__main__':
     print('Done initializing Spotipy client!\n', end='\r')
 
     # Restore centroid_to_graph
-    print('Restoring Graphs...', end='\r')
-    graphs_file = open(args.graphs_file_name, 'rb')
-    centroid_to_graph_save = pickle.load(file=graphs_file)
-    centroid_to_graph = dict()
-    for centroid in centroid_to_graph_save:
-        cur_graph_save = centroid_to_graph_save[centroid]
-        restored_graph = cur_graph_save.restore()
-        centroid_to_graph[centroid] = restored_graph
-    print('Done restoring Graphs!\n', end='\r')
+    # Graphs are only restored when first used
+    print('Opening Graphs...', end='\r')
+    centroid_to_graph = load_graphs(args.graphs_file_name, args.max_resident_graphs)
+    print('Done opening Graphs!\n', end='\r')
 
     # Get song ids from input playlist link
     # Get normalized features for each song id
@@ -61,40 +55,30 @@ if __name__ == '__main__':
     print('Done getting song ids, features; and normalizing features!\n', end='\r')
 
     # Match each song with a graph
-    # - If the song can be found in Graph_Final.pickle / Graph_Final_Evolve.pickle:
+    # - If the song can be found in Graph_Final / Graph_Final_Evolve:
     #       Match song with graph
     # - If the song cannot be found:
     #       Match song with closest graph (by checking distance to graph centroid)
     #       And mutate Graph (to be saved)
     print('Matching songs with graphs...', end='\r')
+    # Songs not in dataset are all matched to their closest centroid at once
+    unknown_songs = [song for song in song_id_to_features
+                     if centroid_to_graph.find_song(song[0]) is None]
+    closest_centroids = centroid_to_graph.nearest_centroids(
+        [song_features for _, song_features in unknown_songs])
+    unknown_song_to_centroid = {song[0]: closest[0] for song, closest
+                                in zip(unknown_songs, closest_centroids)}
+    graph_mutate = unknown_songs != []     # Here graph_mutate means: Graph will mutate
+
     song_to_centroid = dict()
-    graph_mutate = False
     for song in song_id_to_features:
-        cur_song_id, cur_song_features = song
-        is_in_dataset = False
-        corresponding_centroid = None
-        for centroid in centroid_to_graph:
-            if not is_in_dataset:
-                cur_graph = centroid_to_graph[centroid]
-                cur_graph_point_ids = [point.id for point in cur_graph.points]
-                if cur_song_id in cur_graph_point_ids:
-                    is_in_dataset = True
-                    corresponding_centroid = centroid
-        if is_in_dataset:
-            # If song in dataset:
-            song_to_centroid[cur_song_id] = corresponding_centroid
+        cur_song_id = song[0]
+        if cur_song_id in unknown_song_to_centroid:
+            # If song not in dataset:
+            song_to_centroid[cur_song_id] = unknown_song_to_centroid[cur_song_id]
         else:
-            # If song not in dataset, find closest centroid
-            graph_mutate = True     # Here graph_mutate means: Graph will mutate
-            closest_centroid = None
-            closest_centroid_distance = None
-            cur_point = Point(pos=cur_song_features, point_id=cur_song_id)
-            for centroid in centroid_to_graph:
-                distance_to_centroid = cur_point.distance_from(centroid)
-                if closest_centroid_distance == None or distance_to_centroid < closest_centroid_distance:
-                    closest_centroid = centroid
-                    closest_centroid_distance = distance_to_centroid
-            song_to_centroid[cur_song_id] = closest_centroid
+            # If song in dataset:
+            song_to_centroid[cur_song_id] = centroid_to_graph.find_song(cur_song_id)
     # Before making recommendations:
     # Convert song_to_centroid => centroid_to_songs
     # to avoid duplicate recommendations
@@ -129,22 +113,14 @@ if __name__ == '__main__':
         out_file.write(f'{recommendation}\n')
     print('Done Writing to Recommendations.txt!\n', end='\r')
 
-    # If graph(s) mutated: Save to Graph_Final_Evolve.pickle
+    # If graph(s) mutated: Save to the Graph_Final_Evolve graph artifact
     # Unlike before, here graph_mutate means: Graph mutated
     if graph_mutate:
         print('Graph(s) were mutated during the recommendation process,', end=' ')
         print('because the input playlist included song(s) that were not found in the graph file.\n', end='\r')
-        print('Saving mutated Graphs to Graph_Final_Evolve.pickle...')
-        centroid_to_graph_save = dict()
-        for centroid in centroid_to_graph:
-            cur_graph = centroid_to_graph[centroid]
-            cur_graph_save = Graph_Save()
-            cur_graph_save.save(cur_graph)
-            centroid_to_graph_save[centroid] = cur_graph_save
-        save_file = open('Graph_Final_Evolve.pickle', 'wb')
-        pickle.dump(obj=centroid_to_graph_save, file=save_file, protocol=pickle.HIGHEST_PROTOCOL)
-        save_file.close()
-        print('Done saving mutated Graphs to Graph_Final_Evolve.pickle!')
+        print('Saving mutated Graphs to Graph_Final_Evolve...')
+        save_graphs(centroid_to_graph, 'Graph_Final_Evolve')
+        print('Done saving mutated Graphs to Graph_Final_Evolve!')
     else:
         print('Graph(s) were not mutated during the recommendation process,', end=' ')
         print('because all songs in the input playlist were found in the graph file.\n', end='\r')
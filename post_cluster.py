@@ -37,17 +37,23 @@ This file is Copyright (c) 2021 Si Yuan Zhao, Hayk Nazaryan, Cliff Zhang, Joanne
 
 from __future__ import annotations
 import random
-from collections import deque
+import itertools
+import math
+import multiprocessing
+import time
 import pickle
 from argparse import ArgumentParser
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
 import spotipy
 from Point import Point
 from preprocess import Data
 from spotify_client import Spotify_Client
 from k_means import KMeansAlgo
-from typing import Any, List
+from typing import Any, Callable, Iterator, List, Optional
 
 
 DATA = Data()
@@ -55,6 +61,340 @@ CLIENT_CREDENTIALS_MANAGER = spotipy.oauth2.SpotifyClientCredentials(
     'daf1fbca87e94c9db377c98570e32ece', '1a674398d1bb44859ccaa4488df1aaa9')
 SPOTIPY = spotipy.Spotify(client_credentials_manager=CLIENT_CREDENTIALS_MANAGER)
 
+# How Graph.init_edges finds the pairs of points within epsilon of each other:
+# 'brute' compares every pair of points, 'kd-tree' queries a KD-tree built once per graph,
+# 'grid' hashes the points into cells of side epsilon and only compares neighbouring cells,
+# 'tiled' computes the distances of all pairs as matrix products, one tile at a time
+NEIGHBOUR_SEARCHES = ('brute', 'kd-tree', 'grid', 'tiled')
+
+# Default number of rows in a tile of the 'tiled' search, and the most memory (in bytes) a
+# single (tile_size x tile_size) tile may use while it is searched; tiles are shrunk to fit
+DEFAULT_TILE_SIZE = 2048
+DEFAULT_MAX_TILE_BYTES = 64 * 1024 * 1024
+
+# Bytes per entry of a tile of the 'tiled' search at its peak: the float64 distance, then the
+# bool mask plus, if every pair of the tile is close, an int64 flat index and an int64 pair
+TILE_ENTRY_BYTES = 25
+
+# Bytes per entry of a block of the 'grid' search at its peak: the float64 squared distances,
+# a float64 difference along one dimension, the bool mask and, if every pair of the block is
+# close, the two int64 indices of each pair
+GRID_ENTRY_BYTES = 33
+
+# Default number of points of a cluster whose distances calibrate_epsilon samples
+DEFAULT_CALIBRATION_SAMPLE = 500
+
+# Number of dimensions (those with the largest spread) the 'grid' search hashes on. Each
+# cell is compared with its 3 ** GRID_DIMENSIONS neighbouring cells
+GRID_DIMENSIONS = 3
+
+# Spatial indexes are queried with a radius this much (relatively) larger than epsilon, and
+# the candidates are then filtered on their exact distances (see pair_distances), so that
+# rounding differences never change which edges are made
+RADIUS_SLACK = 1e-9
+
+
+class IdInterner:
+    """
+    Maps each song id (a 22 character string) to a dense integer, in the order the ids were
+    first seen, so that graphs can work with small integers instead of strings.
+
+    Instance Attributes:
+        - ids: list of the interned song ids, ids[i] being the id interned as i
+        - index: a dictionary mapping each interned song id to its integer
+
+    Representation Invariants:
+        - all(self.index[self.ids[i]] == i for i in range(len(self.ids)))
+    """
+
+    ids: List[str]
+    index: dict
+
+    def __init__(self) -> None:
+        """
+        Initialize an IdInterner with no ids
+        """
+        self.ids = []
+        self.index = dict()
+
+    def __len__(self) -> int:
+        """
+        Return the number of interned ids
+        """
+        return len(self.ids)
+
+    def intern(self, song_id: str) -> int:
+        """
+        Return the integer of song_id, interning it first if it is new
+        """
+        if song_id not in self.index:
+            self.index[song_id] = len(self.ids)
+            self.ids.append(song_id)
+        return self.index[song_id]
+
+    def song_id(self, i: int) -> str:
+        """
+        Return the song id interned as i
+        """
+        return self.ids[i]
+
+
+# The interner shared by every graph loaded in this process
+SONG_IDS = IdInterner()
+
+
+class Adjacency:
+    """
+    Compact adjacency lists of an undirected graph whose vertices are numbered 0 to n - 1,
+    in compressed sparse row (CSR) form. Each vertex's neighbours are stored sorted by
+    distance, so an edge costs 8 bytes per direction (an int32 index and a float32 distance).
+
+    Instance Attributes:
+        - offsets: int64 array of length n + 1; the neighbours of vertex i are
+          indices[offsets[i]:offsets[i + 1]]
+        - indices: int32 array of the neighbours of every vertex, closest first
+        - distances: float32 array of the distance to each neighbour in indices
+
+    Representation Invariants:
+        - len(self.indices) == len(self.distances) == self.offsets[-1]
+        - every edge is stored in both directions
+    """
+
+    offsets: np.ndarray
+    indices: np.ndarray
+    distances: np.ndarray
+
+    def __init__(self, offsets: np.ndarray, indices: np.ndarray, distances: np.ndarray) -> None:
+        """
+        Initialize Adjacency from its CSR arrays
+        """
+        self.offsets = offsets
+        self.indices = indices
+        self.distances = distances
+
+    def __len__(self) -> int:
+        """
+        Return the number of vertices
+        """
+        return len(self.offsets) - 1
+
+    def neighbours(self, i: int) -> List[int]:
+        """
+        Return the neighbours of vertex i, closest first
+        """
+        return self.indices[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+    def num_edges(self) -> int:
+        """
+        Return the number of (undirected) edges
+        """
+        return len(self.indices) // 2
+
+    def pairs(self) -> List[tuple]:
+        """
+        Return every edge once, as a pair (i, j) with i < j
+        """
+        rows = np.repeat(np.arange(len(self)), np.diff(self.offsets))
+        upper = rows < self.indices
+        return list(zip(rows[upper].tolist(), self.indices[upper].tolist()))
+
+    def add_vertex(self, neighbours: List[int], distances: List[float]) -> None:
+        """
+        Add a new vertex (numbered len(self)) with an edge to each vertex in neighbours, at the
+        corresponding distance in distances. The order of the existing neighbours of every
+        vertex is kept, with the new vertex inserted among them by distance (after those at
+        an equal distance). Only the lists of the vertices in neighbours are searched.
+
+        Preconditions:
+            - len(neighbours) == len(distances)
+            - all(0 <= i < len(self) for i in neighbours)
+            - neighbours has no duplicates
+        """
+        n = len(self)
+        neighbours = np.asarray(neighbours, dtype=np.int64)
+        distances = np.asarray(distances, dtype=np.float32)
+
+        # Insert in increasing vertex order, so that the new entry at the end of one list
+        # goes before the one at the start of the next
+        by_vertex = np.argsort(neighbours, kind='stable')
+        positions = [self.offsets[i] + np.searchsorted(
+            self.distances[self.offsets[i]:self.offsets[i + 1]], distance, side='right')
+            for i, distance in zip(neighbours[by_vertex].tolist(),
+                                   distances[by_vertex].tolist())]
+        by_distance = np.argsort(distances, kind='stable')
+
+        offsets = np.empty(n + 2, dtype=np.int64)
+        offsets[0] = 0
+        np.cumsum(np.bincount(neighbours, minlength=n), out=offsets[1:n + 1])
+        offsets[:n + 1] += self.offsets
+        offsets[n + 1] = offsets[n] + len(neighbours)
+        self.indices = np.concatenate((np.insert(self.indices, positions, np.int32(n)),
+                                       neighbours[by_distance].astype(np.int32)))
+        self.distances = np.concatenate((np.insert(self.distances, positions,
+                                                   distances[by_vertex]),
+                                         distances[by_distance]))
+        self.offsets = offsets
+
+
+def adjacency_from_points(points: List[Point]) -> Adjacency:
+    """
+    Return the Adjacency of points, with vertex i being points[i], built from the
+    neighbours dictionaries of the points (in the same, distance-sorted, order)
+
+    Preconditions:
+        - every neighbour of a point in points is in points
+    """
+    index = {point: i for i, point in enumerate(points)}
+    offsets = [0]
+    indices = []
+    distances = []
+    for point in points:
+        for distance, neighbour in sorted(point.neighbours.items(), key=lambda item: item[0]):
+            indices.append(index[neighbour])
+            distances.append(distance)
+        offsets.append(len(indices))
+    return Adjacency(np.array(offsets, dtype=np.int64), np.array(indices, dtype=np.int32),
+                     np.array(distances, dtype=np.float32))
+
+
+def adjacency_from_edges(n: int, first: np.ndarray, second: np.ndarray,
+                         distances: np.ndarray) -> Adjacency:
+    """
+    Return the Adjacency of n vertices with an edge between first[k] and second[k] of
+    length distances[k], for every k. Neighbours at equal distances are listed in the order
+    of their edges.
+
+    Preconditions:
+        - len(first) == len(second) == len(distances)
+        - all(0 <= i < n for i in first) and all(0 <= j < n for j in second)
+    """
+    return _csr_from_coo(n, np.stack((first, second), axis=1).ravel(),
+                         np.stack((second, first), axis=1).ravel(),
+                         np.repeat(distances, 2))
+
+
+def pair_distances(positions: np.ndarray, first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """
+    Return the float64 array of the distance between positions[first[k]] and
+    positions[second[k]], for every k. The squares are added up one dimension at a time,
+    as in Point.distance_from, so the distances are exactly the same.
+
+    Preconditions:
+        - len(first) == len(second)
+    """
+    accumulator = np.zeros(len(first), dtype=np.float64)
+    if len(first) == 0:
+        return accumulator
+    for dimension in range(positions.shape[1]):
+        accumulator += (positions[first, dimension] - positions[second, dimension]) ** 2
+    return np.sqrt(accumulator)
+
+
+def _exact_pairs(positions: np.ndarray, candidates: np.ndarray, epsilon: float) -> tuple:
+    """
+    Helper function for Graph.epsilon_pairs and Graph.k_nearest_pairs.
+    Return a tuple (pairs, distances): the rows [i, j] of candidates whose rows of positions
+    are within epsilon of each other, in sorted order, and the float64 array of their
+    distances (see pair_distances, so the check is the same as with Point.distance_from).
+
+    Preconditions:
+        - candidates has no duplicate rows
+    """
+    candidates = candidates.reshape(-1, 2)
+    candidates = candidates[np.lexsort((candidates[:, 1], candidates[:, 0]))]
+    distances = pair_distances(positions, candidates[:, 0], candidates[:, 1])
+    close = distances <= epsilon
+    return candidates[close], distances[close]
+
+
+def _csr_from_coo(n: int, rows: np.ndarray, cols: np.ndarray,
+                  distances: np.ndarray) -> Adjacency:
+    """
+    Helper function for Adjacency construction.
+    Return the Adjacency of n vertices with a directed entry cols[k] in the list of rows[k]
+    for every k, each list sorted by distance. The sort is stable, so entries at equal
+    distances keep their order.
+    """
+    order = np.lexsort((distances, rows))
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=offsets[1:])
+    return Adjacency(offsets, np.asarray(cols)[order].astype(np.int32),
+                     np.asarray(distances)[order].astype(np.float32))
+
+
+class SparseQueryEngine:
+    """
+    Answers batches of "which songs are at depth d from this song" queries on a graph by
+    frontier expansion with scipy.sparse: every query is a column of a sparse boolean
+    frontier matrix, and one step deeper for all queries at once is a single product with the
+    adjacency matrix, with the songs each query has already visited masked out.
+
+    Unlike Graph.bfs, the songs at a depth are found as a set, not in search order.
+
+    Instance Attributes:
+        - adjacency: the Adjacency the engine was built from
+        - offsets: adjacency.offsets when the engine was built (Adjacency.add_vertex replaces
+          it, so a different array means the engine is out of date)
+        - matrix: the (n x n) adjacency matrix, with a 1 at (i, j) for each edge between i and j
+
+    Representation Invariants:
+        - self.matrix.shape == (len(self.adjacency), len(self.adjacency))
+    """
+
+    adjacency: Adjacency
+    offsets: np.ndarray
+    matrix: csr_matrix
+
+    def __init__(self, adjacency: Adjacency) -> None:
+        """
+        Initialize a SparseQueryEngine over adjacency
+        """
+        n = len(adjacency)
+        self.adjacency = adjacency
+        self.offsets = adjacency.offsets
+        self.matrix = csr_matrix((np.ones(len(adjacency.indices), dtype=np.int32),
+                                  adjacency.indices, adjacency.offsets), shape=(n, n))
+
+    def depth_sets(self, queries: List[tuple]) -> List[np.ndarray]:
+        """
+        Return, for each query (root, adventure) in queries, the sorted array of the vertices
+        at depth exactly adventure from vertex root (the root itself, if adventure == 0)
+
+        Preconditions:
+            - all(0 <= root < len(self.adjacency) and adventure >= 0
+                  for root, adventure in queries)
+        """
+        n = len(self.adjacency)
+        num_queries = len(queries)
+        roots = np.array([root for root, _ in queries], dtype=np.int64)
+        adventures = np.array([adventure for _, adventure in queries], dtype=np.int64)
+        results = [np.zeros(0, dtype=np.int64)] * num_queries
+
+        # Column q of frontier is the current depth of query q
+        frontier = csr_matrix((np.ones(num_queries, dtype=np.int32),
+                               (roots, np.arange(num_queries))), shape=(n, num_queries))
+        visited = np.zeros((n, num_queries), dtype=bool)
+        visited[roots, np.arange(num_queries)] = True
+
+        for depth in range(int(adventures.max(initial=0)) + 1):
+            if depth > 0:
+                reached = (self.matrix @ frontier).tocoo()
+                new = ~visited[reached.row, reached.col]
+                rows, cols = reached.row[new], reached.col[new]
+                visited[rows, cols] = True
+                frontier = csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                                      shape=(n, num_queries))
+
+            done = np.flatnonzero(adventures == depth)
+            if len(done) > 0:
+                columns = frontier.tocsc()
+                for q in done.tolist():
+                    results[q] = np.sort(columns.indices[columns.indptr[q]:columns.indptr[q + 1]])
+            if frontier.nnz == 0:
+                break
+
+        return results
+
 
 class Graph:
     """
@@ -66,14 +406,42 @@ class Graph:
         - epsilon: float representing a distance
         - id_point_mapping: a dictionary a str ID to a Point object
         - song_ids: list of ids
+        - neighbour_search: how init_edges finds close points, one of NEIGHBOUR_SEARCHES
+        - tile_size: the number of rows in a tile, for the 'tiled' neighbour search
+        - max_tile_bytes: the memory ceiling of a tile, for the 'tiled' neighbour search (and
+          of a block of two cells, for the 'grid' neighbour search)
+        - k_nearest: if not None, connect each point to its k_nearest nearest points instead
+          of to every point within epsilon (epsilon then only caps the length of an edge)
+        - mutual: in k_nearest mode, only connect two points if each is among the k_nearest
+          nearest points of the other
+        - adjacency: the edges, where vertex i is self.points[i] (None until first needed;
+          see get_adjacency)
+        - vertex_ids: int32 array of the id of each point in self.points, interned in SONG_IDS
+        - id_index: a dictionary mapping an interned ID to the index of its point in
+          self.points
+        - on_new_point: if not None, called with each Point added by init_new_point
+        - sparse_engine: the SparseQueryEngine of self.adjacency, once one was needed (see
+          get_sparse_engine)
     """
 
     points: list
     epsilon: float
     id_point_mapping: dict
     song_ids: Any
-
-    def __init__(self, points=[], epsilon=-1) -> None:
+    neighbour_search: str
+    tile_size: int
+    max_tile_bytes: int
+    k_nearest: Any
+    mutual: bool
+    adjacency: Optional[Adjacency]
+    vertex_ids: np.ndarray
+    id_index: dict
+    on_new_point: Optional[Callable[[Point], Any]]
+    sparse_engine: Optional[SparseQueryEngine]
+
+    def __init__(self, points=[], epsilon=-1, neighbour_search='kd-tree',
+                 tile_size=DEFAULT_TILE_SIZE, max_tile_bytes=DEFAULT_MAX_TILE_BYTES,
+                 k_nearest=None, mutual=False, adjacency=None) -> None:
         """
         Initialize Graph class
         """
@@ -81,6 +449,68 @@ class Graph:
         self.epsilon = epsilon
         self.id_point_mapping = {point.id: point for point in self.points}
         self.song_ids = list(self.id_point_mapping.keys())
+        self.neighbour_search = neighbour_search
+        self.tile_size = tile_size
+        self.max_tile_bytes = max_tile_bytes
+        self.k_nearest = k_nearest
+        self.mutual = mutual
+        self.adjacency = adjacency
+        self.vertex_ids = np.array([SONG_IDS.intern(point.id) for point in self.points],
+                                   dtype=np.int32)
+        self.id_index = {vertex_id: i for i, vertex_id in enumerate(self.vertex_ids.tolist())}
+        self.on_new_point = None
+        self.sparse_engine = None
+
+    def get_adjacency(self) -> Adjacency:
+        """
+        Return self.adjacency, first building it (see compact) if it does not exist yet
+        """
+        if self.adjacency is None:
+            self.compact()
+        return self.adjacency
+
+    def compact(self) -> None:
+        """
+        Move the edges from the neighbours dictionaries of the points into self.adjacency,
+        and empty those dictionaries. From then on the graph only uses self.adjacency.
+        """
+        self.adjacency = adjacency_from_points(self.points)
+        for point in self.points:
+            point.neighbours = dict()
+
+    def edge_ids(self) -> set:
+        """
+        Return the edges as a set of tuples, each the two (sorted) ids of the songs connected
+        """
+        return {tuple(sorted([self.points[i].id, self.points[j].id]))
+                for i, j in self.get_adjacency().pairs()}
+
+    def get_sparse_engine(self) -> SparseQueryEngine:
+        """
+        Return the SparseQueryEngine of self.adjacency, building a new one if there is none
+        yet or the edges changed since it was built
+        """
+        adjacency = self.get_adjacency()
+        if self.sparse_engine is None or self.sparse_engine.adjacency is not adjacency \
+                or self.sparse_engine.offsets is not adjacency.offsets:
+            self.sparse_engine = SparseQueryEngine(adjacency)
+        return self.sparse_engine
+
+    def depth_songs(self, queries: List[tuple]) -> List[List[str]]:
+        """
+        Return, for each query (song id, adventure) in queries, the ids of the songs at
+        depth=adventure from that song, other than the song itself, in the order of
+        self.points. All queries are answered together by self.get_sparse_engine().
+
+        Preconditions:
+            - all(song_id in self.id_point_mapping and adventure >= 0
+                  for song_id, adventure in queries)
+        """
+        roots = [self.id_index[SONG_IDS.intern(song_id)] for song_id, _ in queries]
+        depth_sets = self.get_sparse_engine().depth_sets(
+            [(root, adventure) for root, (_, adventure) in zip(roots, queries)])
+        return [[self.points[i].id for i in depth_set.tolist() if self.points[i].id != song_id]
+                for (song_id, _), depth_set in zip(queries, depth_sets)]
 
     def draw_with_matplotlib(self) -> None:
         """
@@ -91,24 +521,25 @@ class Graph:
 
         dimension = len(self.points[0].pos)
         xs, ys, zs = [], [], []
+        adjacency = self.get_adjacency()
 
         if dimension >= 3:
-            for point in self.points:
+            for i, point in enumerate(self.points):
                 x, y, z = point.pos[:3]
                 xs.append(x)
                 ys.append(y)
                 zs.append(z)
-                for neighbour in point.neighbours.values():
+                for neighbour in map(self.points.__getitem__, adjacency.neighbours(i)):
                     neighbour_x, neighbour_y, neighbour_z = neighbour.pos[:3]
                     ax.plot(xs=[x, neighbour_x], ys=[y, neighbour_y], zs=[z, neighbour_z],
                             color='blue')
         elif dimension == 2:
             zs = [0] * len(self.points)
-            for point in self.points:
+            for i, point in enumerate(self.points):
                 x, y = point.pos[:2]
                 xs.append(x)
                 ys.append(y)
-                for neighbour in point.neighbours.values():
+                for neighbour in map(self.points.__getitem__, adjacency.neighbours(i)):
                     neighbour_x, neighbour_y = neighbour.pos[:2]
                     ax.plot(xs=[x, neighbour_x], ys=[y, neighbour_y], zs=[0, 0],
                             color='blue')
@@ -137,14 +568,15 @@ class Graph:
 
         dimension = len(self.points[0].pos)
         xs, ys, zs = [], [], []
+        adjacency = self.get_adjacency()
 
         if dimension >= 3:
-            for point in self.points:
+            for i, point in enumerate(self.points):
                 x, y, z = point.pos[x_i], point.pos[y_i], point.pos[z_i]
                 xs.append(x)
                 ys.append(y)
                 zs.append(z)
-                for neighbour in point.neighbours.values():
+                for neighbour in map(self.points.__getitem__, adjacency.neighbours(i)):
                     neighbour_x, neighbour_y, neighbour_z = neighbour.pos[:3]
                     ax.plot(xs=[x, neighbour_x], ys=[y, neighbour_y], zs=[z, neighbour_z],
                             color='blue')
@@ -173,8 +605,13 @@ class Graph:
         pickle_file.close()
         self.points = restored_graph.points
         self.epsilon = restored_graph.epsilon
+        self.k_nearest = restored_graph.k_nearest
+        self.mutual = restored_graph.mutual
+        self.adjacency = restored_graph.adjacency
         self.id_point_mapping = {point.id: point for point in self.points}
         self.song_ids = list(self.id_point_mapping.keys())
+        self.vertex_ids = restored_graph.vertex_ids
+        self.id_index = restored_graph.id_index
 
     def init_edges(self) -> None:
         """
@@ -182,41 +619,192 @@ class Graph:
         For each point:
         - Become neighbour (make edge) with all points within self.epsilon
         - If no points were found in self.epsilon, become neighbour with closest point
+
+        Unless self.neighbour_search is 'brute', the pairs within self.epsilon are found
+        with a spatial index (see self.epsilon_pairs). The edges are the same either way.
+
+        If self.k_nearest is set, each point is instead connected to its k nearest points
+        within self.epsilon (see self.k_nearest_pairs), and a point left without any is
+        connected to its nearest point.
+
+        self.adjacency is built directly from the pairs, without going through the
+        neighbours dictionaries of the points.
         """
-        noise = []
-        progress = 0
-        for point in self.points:
-            close_points = self.points_within_epsilon(point)
-            if len(close_points) == 0:
-                noise.append(point)
-            else:
-                for close_point in close_points:
-                    if not point.is_neighbour_with(close_point):
-                        point.become_neighbour(close_point)
-                progress += 1
-                print(f'Progress: {progress} / {len(self.points)} => '
-                      f'{round(progress * 100 / len(self.points), 2)}%',
-                      end='\r')
-        for far_point in noise:
-            closest_point = self.points[self.closest_point_index(far_point)]
-            far_point.become_neighbour(closest_point)
-            progress += 1
-            print(f'Progress: {progress} / {len(self.points)} => '
-                  f'{round(progress * 100 / len(self.points), 2)}%',
+        if self.k_nearest is not None:
+            pairs, distances = self.k_nearest_pairs()
+        elif self.neighbour_search == 'brute':
+            pairs, distances = self._brute_epsilon_pairs()
+        else:
+            pairs, distances = self.epsilon_pairs()
+        has_neighbour = np.zeros(len(self.points), dtype=bool)
+        has_neighbour[pairs.ravel()] = True
+
+        noise_pairs = np.array(self._noise_pairs(np.flatnonzero(~has_neighbour).tolist()),
+                               dtype=np.int64).reshape(-1, 2)
+        print(f'Made {len(pairs)} edges and {len(noise_pairs)} edges for noise points')
+
+        positions = np.array([point.pos for point in self.points], dtype=np.float64)
+        edges = np.concatenate((pairs, noise_pairs))
+        self.adjacency = adjacency_from_edges(
+            len(self.points), edges[:, 0], edges[:, 1],
+            np.concatenate((distances, pair_distances(positions, noise_pairs[:, 0],
+                                                      noise_pairs[:, 1]))))
+
+    def _noise_pairs(self, noise: List[int]) -> List[tuple]:
+        """
+        Helper function for init_edges.
+        Return the edges connecting each point of noise (indices in self.points) to its
+        closest other point (in k_nearest mode, its nearest point, see
+        _nearest_other_indices), each edge once as a pair (i, j), i < j, in the order they
+        are made. Two noise points picking each other make a single edge, and there are no
+        edges if there is no other point.
+        """
+        if len(self.points) < 2:
+            return []
+        if self.k_nearest is None:
+            closest_indices = [self.closest_point_index(self.points[i]) for i in noise]
+        else:
+            closest_indices = self._nearest_other_indices(noise)
+        return list(dict.fromkeys((min(i, j), max(i, j))
+                                  for i, j in zip(noise, closest_indices)))
+
+    def k_nearest_pairs(self) -> tuple:
+        """
+        Return a tuple (pairs, distances) as in self.epsilon_pairs, of the index pairs
+        [i, j], i < j, such that self.points[j] is one of the self.k_nearest nearest points to
+        self.points[i] or vice versa (both, if self.mutual), and the two are within
+        self.epsilon of each other (if self.epsilon > 0).
+
+        There are at most n * self.k_nearest pairs however dense the points are, and with
+        self.mutual no point is in more than self.k_nearest pairs.
+        """
+        n = len(self.points)
+        positions = np.array([point.pos for point in self.points], dtype=np.float64)
+        if n < 2:
+            return _exact_pairs(positions, np.zeros((0, 2), dtype=np.int64), np.inf)
+        k = min(self.k_nearest, n - 1)
+        radius = self.epsilon * (1 + RADIUS_SLACK) if self.epsilon > 0 else np.inf
+
+        # Ask for one extra neighbour since each point is usually its own nearest point. With
+        # duplicate positions it may not be returned at all, so only the first k others count
+        _, indices = cKDTree(positions).query(positions, k=k + 1, distance_upper_bound=radius)
+        rows = np.broadcast_to(np.arange(n)[:, None], indices.shape)
+        found = (indices != rows) & (indices < n)
+        found &= np.cumsum(found, axis=1) <= k
+        directed = rows[found] * n + indices[found]
+
+        # Each pair (i, j) is encoded as the single integer i * n + j
+        first, second = np.divmod(directed, n)
+        if self.mutual:
+            pairs = directed[(first < second) & np.isin(second * n + first, directed)]
+        else:
+            pairs = np.unique(np.minimum(first, second) * n + np.maximum(first, second))
+        candidates = np.stack(np.divmod(pairs, n), axis=1)
+        return _exact_pairs(positions, candidates, self.epsilon if self.epsilon > 0 else np.inf)
+
+    def _nearest_other_indices(self, indices: List[int]) -> List[int]:
+        """
+        Return, for each index in indices, the index of the point nearest to that point
+        (other than itself)
+
+        Preconditions:
+            - len(self.points) > 1
+        """
+        if len(indices) == 0:
+            return []
+        positions = np.array([point.pos for point in self.points], dtype=np.float64)
+        _, nearest = cKDTree(positions).query(positions[indices], k=2)
+        return [int(row[1]) if row[0] == i else int(row[0])
+                for i, row in zip(indices, nearest.tolist())]
+
+    def k_nearest_points(self, point: Point) -> List[int]:
+        """
+        Return the indices (in self.points) of the self.k_nearest points nearest to point
+        (other than itself) that are within self.epsilon of it (if self.epsilon > 0). If
+        self.mutual, only those that also have point among their own self.k_nearest nearest
+        points are returned.
+        """
+        other_indices = [i for i, a_point in enumerate(self.points) if a_point is not point]
+        if len(other_indices) == 0:
+            return []
+        others = [self.points[i] for i in other_indices]
+        positions = np.array([a_point.pos for a_point in others], dtype=np.float64)
+        distances = np.sqrt(((positions - np.array(point.pos)) ** 2).sum(axis=1))
+        nearest = np.argsort(distances, kind='stable')[:self.k_nearest].tolist()
+        if self.mutual:
+            nearest = [i for i in nearest
+                       if self._num_closer(positions, i, distances[i]) < self.k_nearest]
+        return [other_indices[i] for i in nearest
+                if self.epsilon <= 0 or point.distance_from(others[i]) <= self.epsilon]
+
+    def _num_closer(self, positions: np.ndarray, i: int, distance: float) -> int:
+        """
+        Helper function for k_nearest_points.
+        Return the number of rows of positions other than row i that are strictly closer
+        than distance to row i. (Ties count as not closer, so a new point at the same
+        distance as the k-th nearest point of row i is among its k nearest.)
+        """
+        distances = np.sqrt(((positions - positions[i]) ** 2).sum(axis=1))
+        distances[i] = np.inf
+        return int(np.count_nonzero(distances < distance))
+
+    def epsilon_pairs(self) -> tuple:
+        """
+        Return a tuple (pairs, distances): the int64 array of all index pairs [i, j], i < j,
+        such that self.points[i] and self.points[j] are within self.epsilon of each other,
+        one row per pair in sorted order, and the float64 array of the distance of each pair.
+
+        A spatial index over the positions ('kd-tree' or 'grid', see NEIGHBOUR_SEARCHES) is
+        built once and queried for every pair within the radius, or ('tiled') the distances
+        are computed tile by tile. The candidates are then checked exactly, all at once (see
+        _exact_pairs).
+        """
+        positions = np.array([point.pos for point in self.points], dtype=np.float64)
+        if len(self.points) < 2:
+            return _exact_pairs(positions, np.zeros((0, 2), dtype=np.int64), self.epsilon)
+        radius = self.epsilon * (1 + RADIUS_SLACK)
+        if self.neighbour_search == 'grid':
+            candidates = _grid_pairs(positions, radius, self.max_tile_bytes)
+        elif self.neighbour_search == 'tiled':
+            candidates = np.concatenate(
+                [np.zeros((0, 2), dtype=np.int64)] +
+                list(tiled_epsilon_pairs(positions, radius, self.tile_size, self.max_tile_bytes)))
+        else:
+            candidates = cKDTree(positions).query_pairs(
+                radius, output_type='ndarray').astype(np.int64)
+        return _exact_pairs(positions, candidates, self.epsilon)
+
+    def _brute_epsilon_pairs(self) -> tuple:
+        """
+        Return the same tuple (pairs, distances) as self.epsilon_pairs, by comparing every
+        pair of points with Point.distance_from
+        """
+        pairs = []
+        distances = []
+        for i, point in enumerate(self.points):
+            for j in range(i + 1, len(self.points)):
+                distance = point.distance_from(self.points[j])
+                if distance <= self.epsilon:
+                    pairs.append((i, j))
+                    distances.append(distance)
+            print(f'Progress: {i + 1} / {len(self.points)} => '
+                  f'{round((i + 1) * 100 / len(self.points), 2)}%',
                   end='\r')
         print('\r')
+        return (np.array(pairs, dtype=np.int64).reshape(-1, 2),
+                np.array(distances, dtype=np.float64))
 
-    def points_within_epsilon(self, point: Point) -> Any:
+    def points_within_epsilon(self, point: Point) -> List[int]:
         """
-        Return points within self.epsilon
+        Return the indices (in self.points) of the points within self.epsilon
         """
-        close_points = []
-        for a_point in self.points:
+        close_indices = []
+        for i, a_point in enumerate(self.points):
             if a_point is point:
                 continue
             if point.distance_from(a_point) <= self.epsilon:
-                close_points.append(a_point)
-        return close_points
+                close_indices.append(i)
+        return close_indices
 
     def closest_point_index(self, point: Point) -> Any:
         """
@@ -243,49 +831,60 @@ class Graph:
         Handle fails:
         - For each fail: Find random song from self.points, as long as the
           song is not in previous recommendations
+
+        Internally, songs are handled by their ids interned in SONG_IDS, and only the
+        returned recommendations are translated back to str ids. The input songs and the
+        recommendations so far are kept in a single set, which every search checks against.
+
+        The songs at depth=adventure from every input song are found together by
+        self._bfs_many, once per run of input songs between songs added to the graph (each
+        search sees the graph as it was when that input song came up). The results are the
+        same as searching from each input song in turn with self.bfs().
         """
         recommendations = []
         fails = 0      # too many fails means cluster too small and/or adventure too big
-        for input_song_id in input_song_ids:
-            if input_song_id in self.song_ids:
-                blacklist = recommendations + input_song_ids
-                res = self.bfs(input_song_id, adventure, blacklist)
-                if res['success']:
-                    recommendations.append(res['data'])
-                else:
-                    fails += 1
-                    continue
-            else:
+        input_vertex_ids = [SONG_IDS.intern(song_id) for song_id in input_song_ids]
+        blacklist = set(input_vertex_ids)
+
+        depth_songs = [[] for _ in input_song_ids]
+        pending = []    # input songs whose search can wait until the graph next changes
+        for i in range(len(input_song_ids)):
+            if input_vertex_ids[i] not in self.id_index:
                 # Handle song not in graph
-                pos = self.get_new_song_pos(input_song_id)
-                new_song = Point(pos, input_song_id)
+                self._fill_depth_songs(pending, input_vertex_ids, adventure, depth_songs)
+                pending = []
+                pos = self.get_new_song_pos(input_song_ids[i])
+                new_song = Point(pos, input_song_ids[i])
                 self.init_new_point(new_song)
+            pending.append(i)
+        self._fill_depth_songs(pending, input_vertex_ids, adventure, depth_songs)
 
-                blacklist = recommendations + input_song_ids
-                res = self.bfs(input_song_id, adventure, blacklist)
-                if res['success']:
-                    recommendations.append(res['data'])
-                else:
-                    fails += 1
-                    continue
+        for i in range(len(input_song_ids)):
+            found = self._first_allowed(depth_songs[i], input_vertex_ids[i], blacklist)
+            if found is None:
+                fails += 1
+            else:
+                recommendations.append(int(self.vertex_ids[found]))
+                blacklist.add(recommendations[-1])
 
         # Handle fails: Find random song in graph
         # Will still be good results overall because graph is a cluster from kmeans,
         # songs in a given cluster share explicable/inexplicable resemblance
         if fails:
-            shuffled_songs = random.sample(self.song_ids, len(self.song_ids))
+            vertex_ids = list(self.id_index)
+            shuffled_songs = random.sample(vertex_ids, len(vertex_ids))
             counter = 0
             for _ in range(fails):
                 random_song = shuffled_songs[counter]
-                blacklist = recommendations + input_song_ids
                 while random_song in blacklist:
                     random_song = shuffled_songs[counter]
                     counter += 1
-                    if counter > len(self.song_ids):
+                    if counter > len(vertex_ids):
                         raise Exception('Cluster too small / Asking for too many songs')
                 recommendations.append(random_song)
+                blacklist.add(random_song)
 
-        return recommendations, fails
+        return [SONG_IDS.song_id(vertex_id) for vertex_id in recommendations], fails
 
     def bfs(self, root_song_id: str, adventure: int, blacklist: List[str]) -> dict:
         """
@@ -295,33 +894,111 @@ class Graph:
         - Input (root_song_id) itself
         - Any song in blacklist
         """
-        queue = deque()
-        visited = set()
-        visited.add(root_song_id)
-        queue.append((root_song_id, 0))
-        depth = 0
-        while queue:
-            cur_song_id, cur_depth = queue.popleft()
-
-            # Criteria
-            not_root = cur_song_id != root_song_id
-            adventure_ok = cur_depth == adventure
-            not_blacklisted = cur_song_id not in blacklist
-            if not_root and adventure_ok and not_blacklisted:
-                return {'success': True, 'data': cur_song_id}
-
-            if cur_depth > depth:
-                depth += 1
-
-            cur_song = self.id_point_mapping[cur_song_id]
-            neighbour_keys = sorted(list(cur_song.neighbours.keys()))   # This is distances
-            for neighbour_key in neighbour_keys:
-                neighbour = cur_song.get_neighbour(neighbour_key)
-                if neighbour.id not in visited:
-                    visited.add(neighbour.id)
-                    queue.append((neighbour.id, depth + 1))
-
-        return {'success': False}
+        excluded = {SONG_IDS.intern(song_id) for song_id in blacklist}
+        found = self._bfs(self.id_index[SONG_IDS.intern(root_song_id)], adventure, excluded)
+        if found is None:
+            return {'success': False}
+        return {'success': True, 'data': self.points[found].id}
+
+    def _bfs(self, root: int, adventure: int, blacklist: set) -> Optional[int]:
+        """
+        Return the index (in self.points) of the first song at depth=adventure from the song
+        at index root, or None if there is none. Songs whose interned id is the root's or is
+        in blacklist are skipped.
+
+        The search expands one whole depth at a time over self.adjacency, visiting each
+        song's neighbours closest first, and stops at depth=adventure. Songs at that depth
+        are checked in the order a queue-based search would reach them.
+        """
+        adjacency = self.get_adjacency()
+        offsets, indices = adjacency.offsets, adjacency.indices
+        visited = bytearray(len(adjacency))
+        visited[root] = True
+        frontier = [root]
+
+        for _ in range(adventure):
+            next_frontier = []
+            for cur in frontier:
+                for neighbour in indices[offsets[cur]:offsets[cur + 1]].tolist():
+                    if not visited[neighbour]:
+                        visited[neighbour] = True
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+
+        return self._first_allowed(frontier, int(self.vertex_ids[root]), blacklist)
+
+    def _first_allowed(self, candidates: List[int], root_vertex_id: int,
+                       blacklist: set) -> Optional[int]:
+        """
+        Return the first index (in self.points) in candidates whose song's interned id is
+        neither root_vertex_id nor in blacklist, or None if there is none
+        """
+        for cur, cur_vertex_id in zip(candidates, self.vertex_ids[candidates].tolist()):
+            if cur_vertex_id != root_vertex_id and cur_vertex_id not in blacklist:
+                return cur
+
+        return None
+
+    def _fill_depth_songs(self, pending: List[int], input_vertex_ids: List[int], adventure: int,
+                          depth_songs: List[List[int]]) -> None:
+        """
+        Helper function for self.recommend.
+        Set depth_songs[i] to the songs at depth=adventure from input song i, for every i in
+        pending (see self._bfs_many).
+        """
+        if pending:
+            roots = [self.id_index[input_vertex_ids[i]] for i in pending]
+            for i, songs in zip(pending, self._bfs_many(roots, adventure)):
+                depth_songs[i] = songs
+
+    def _bfs_many(self, roots: List[int], adventure: int) -> List[List[int]]:
+        """
+        Return, for each index (in self.points) in roots, the indices of the songs at
+        depth=adventure from it, in the order self._bfs would check them.
+
+        All searches run together, one depth at a time. Each depth is found for every root
+        at once from (root, song, neighbour) triples: a song reached from several songs of
+        the previous depth is kept for the first of them, which is what puts it in the same
+        place as in a single search. Which songs each search has visited is kept as a
+        (len(roots), len(self.points)) boolean array.
+        """
+        adjacency = self.get_adjacency()
+        offsets, indices = adjacency.offsets, adjacency.indices
+        n = len(adjacency)
+        max_degree = int(np.diff(offsets).max())
+
+        # The current depth, as parallel arrays sorted by root and then by search order
+        sources = np.arange(len(roots))
+        nodes = np.array(roots, dtype=np.int64)
+        ranks = np.zeros(len(roots), dtype=np.int64)
+        visited = np.zeros((len(roots), n), dtype=bool)
+        visited[sources, nodes] = True
+
+        for _ in range(adventure):
+            if len(nodes) == 0:
+                break
+            starts = offsets[nodes]
+            degrees = offsets[nodes + 1] - starts
+            parents = np.repeat(np.arange(len(nodes)), degrees)
+            positions = np.arange(len(parents)) - np.repeat(np.cumsum(degrees) - degrees, degrees)
+            neighbours = indices[starts[parents] + positions].astype(np.int64)
+            edge_sources = sources[parents]
+            keys = ranks[parents] * (max_degree + 1) + positions
+
+            unvisited = ~visited[edge_sources, neighbours]
+            edge_sources = edge_sources[unvisited]
+            neighbours = neighbours[unvisited]
+            order = np.lexsort((keys[unvisited], edge_sources))
+            edge_sources, neighbours = edge_sources[order], neighbours[order]
+
+            _, first = np.unique(edge_sources * n + neighbours, return_index=True)
+            first.sort()
+            sources, nodes = edge_sources[first], neighbours[first]
+            visited[sources, nodes] = True
+            ranks = np.arange(len(sources)) - np.searchsorted(sources, sources)
+
+        bounds = np.searchsorted(sources, np.arange(len(roots) + 1))
+        return [nodes[bounds[i]:bounds[i + 1]].tolist() for i in range(len(roots))]
 
     def get_new_song_pos(self, song_id: str) -> List[float]:
         """
@@ -339,6 +1016,11 @@ class Graph:
         - Become neighbours with all points within self.epsilon
         Otherwise:
         - Become neighbours with closest point
+        If self.k_nearest is set, only the self.k_nearest nearest points within self.epsilon
+        are used, and if self.mutual, only those of them that have the new song among their
+        own self.k_nearest nearest points (see k_nearest_points). Their existing edges are
+        kept, so with self.mutual a point may end up with one more neighbour than
+        self.k_nearest for each song added next to it, until the graph is rebuilt.
         """
         # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         # MAKE SURE THE NEW POINT ACTUALLY BELONGS IN THIS CLUSTER. I.E. CLOSEST TO
@@ -346,18 +1028,30 @@ class Graph:
         # !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         assert new_point.id not in self.song_ids, "New song's id already in self.song_ids"
         print('Initializing new point...', end='\r')
+        adjacency = self.get_adjacency()
         self.points.append(new_point)
         self.id_point_mapping[new_point.id] = new_point
         self.song_ids.append(new_point.id)
-        close_points = self.points_within_epsilon(new_point)
-        if len(close_points) == 0:
-            closest_point = self.points[self.closest_point_index(new_point)]
-            new_point.become_neighbour(closest_point)
+        new_vertex_id = SONG_IDS.intern(new_point.id)
+        self.vertex_ids = np.append(self.vertex_ids, np.int32(new_vertex_id))
+        self.id_index[new_vertex_id] = len(self.points) - 1
+        # Vertices are found by index, since songs with the same id (and features) may
+        # appear more than once in a cluster
+        if self.k_nearest is None:
+            close_indices = self.points_within_epsilon(new_point)
         else:
-            for close_point in close_points:
-                new_point.become_neighbour(close_point)
-        num_edges = len(close_points) if len(close_points) != 0 else 1
-        print(f'Initialized new point with {num_edges} edges!')
+            close_indices = self.k_nearest_points(new_point)
+        if len(close_indices) == 0 and len(self.points) > 1:
+            if self.k_nearest is None:
+                close_indices = [self.closest_point_index(new_point)]
+            else:
+                # The same nearest point init_edges would have connected it to
+                close_indices = self._nearest_other_indices([len(self.points) - 1])
+        adjacency.add_vertex(close_indices, [new_point.distance_from(self.points[i])
+                                             for i in close_indices])
+        print(f'Initialized new point with {len(close_indices)} edges!')
+        if self.on_new_point is not None:
+            self.on_new_point(new_point)
 
 
 class Graph_Save:
@@ -370,57 +1064,292 @@ class Graph_Save:
     (albeit it's still big with big datasets)
 
     Instance Attributes:
-        - points: Set of tuples: each tuple is (point position, point id)
-        - edges: Set of tuples: each tuple is (point A, point B)
+        - points: List of tuples: each tuple is (point position, point id)
+        - edges: int32 array of shape (number of edges, 2): each row is the indices (in
+          points) of the two points connected. Graph_Save objects pickled before were sets
+          of (point A id, point B id) tuples, restore handles both.
         - epsilon: Integer representing Graph epsilon value
           (used for connecting vertices)
+        - k_nearest: Graph k_nearest value (None if vertices were connected by epsilon)
+        - mutual: Graph mutual value
     """
 
-    points: set
-    edges: set
+    points: list
+    edges: Any
     epsilon: int
+    k_nearest: Any
+    mutual: bool
 
     def __init__(self) -> None:
         """
         Initialize a Graph_Save object with no data
         """
-        self.points = set()
-        self.edges = set()
+        self.points = []
+        self.edges = np.zeros((0, 2), dtype=np.int32)
         self.epsilon = -1
+        self.k_nearest = None
+        self.mutual = False
 
     def save(self, graph: Graph) -> None:
         """
         Store all meaningful data from Graph object into attributes
         *meaningful data: Data strictly necessary to restore existing Graph
         """
-        points = set()
-        edges = set()
-        for point in graph.points:
-            points.add((tuple(point.pos), point.id))
-            for neighbour_distance in point.neighbours:
-                neighbour = point.neighbours[neighbour_distance]
-                edges.add(tuple(sorted([point.id, neighbour.id])))
-        self.points = points
-        self.edges = edges
+        self.points = [(tuple(point.pos), point.id) for point in graph.points]
+        self.edges = np.array(graph.get_adjacency().pairs(), dtype=np.int32).reshape(-1, 2)
         self.epsilon = graph.epsilon
+        self.k_nearest = graph.k_nearest
+        self.mutual = graph.mutual
 
     def restore(self) -> Graph:
         """
         Reconstruct from attributes to: Restore and return Graph object
         """
-        points = []
-        id_point_mapping = dict()
-        for point in self.points:
-            point_pos, point_id = point
-            point_obj = Point(point_pos, point_id)
-            points.append(point_obj)
-            id_point_mapping[point_id] = point_obj
-        for edge in self.edges:
-            point_id, neighbour_id = edge
-            point_obj = id_point_mapping[point_id]
-            neighbour_obj = id_point_mapping[neighbour_id]
-            point_obj.become_neighbour(neighbour_obj)
-        return Graph(points=points, epsilon=self.epsilon)
+        points = [Point(point_pos, point_id) for point_pos, point_id in self.points]
+        _, adjacency = self.arrays()
+
+        # Graph_Save objects pickled before k_nearest existed were all connected by epsilon
+        return Graph(points=points, epsilon=self.epsilon,
+                     k_nearest=getattr(self, 'k_nearest', None),
+                     mutual=getattr(self, 'mutual', False), adjacency=adjacency)
+
+    def arrays(self, dimension: int = 0) -> tuple:
+        """
+        Return a tuple (positions, adjacency): the float64 array of the positions of
+        self.points, one row per point, and the Adjacency of the saved edges, where vertex i
+        is self.points[i]
+
+        If there are no points, positions has shape (0, dimension).
+
+        Preconditions:
+            - self.points == [] or dimension in {0, len(self.points[0][0])}
+        """
+        if isinstance(self.edges, set):
+            # Edges pickled as pairs of song ids
+            id_index = {point_id: i for i, (_, point_id) in enumerate(self.points)}
+            edges = np.array([[id_index[a], id_index[b]] for a, b in self.edges],
+                             dtype=np.int64).reshape(-1, 2)
+        else:
+            edges = self.edges.astype(np.int64)
+
+        # Build the adjacency directly from the edges, with all distances computed at once
+        if len(self.points) == 0:
+            positions = np.zeros((0, dimension), dtype=np.float64)
+        else:
+            positions = np.array([point_pos for point_pos, _ in self.points], dtype=np.float64)
+        first, second = edges[:, 0], edges[:, 1]
+        return positions, adjacency_from_edges(len(self.points), first, second,
+                                               pair_distances(positions, first, second))
+
+
+def build_graph_saves(centroid_to_cluster: dict, epsilon: float, workers: int = 1,
+                      target_degree: Optional[float] = None, **graph_options: Any) -> dict:
+    """
+    Make each cluster of centroid_to_cluster into a Graph, initialize its edges and return
+    a dictionary mapping each centroid to the Graph_Save of its graph (in the same order as
+    centroid_to_cluster). graph_options are passed on to Graph.
+
+    If target_degree is given, epsilon is ignored and each cluster gets its own epsilon,
+    picked by calibrate_epsilon so that its songs have about target_degree neighbours on
+    average. Either way, the epsilon, number of edges and build time of each cluster are
+    printed as a table.
+
+    If workers > 1, the graphs are built and converted to Graph_Save objects in a pool of
+    workers processes. The clusters are independent, so they are handed out largest first,
+    which keeps the last few workers from finishing long after the others.
+
+    Preconditions:
+        - workers > 0
+        - target_degree is None or target_degree > 0
+    """
+    centroids = list(centroid_to_cluster)
+    jobs = [(i, centroid_to_cluster[centroids[i]], epsilon, target_degree, graph_options)
+            for i in range(len(centroids))]
+    jobs.sort(key=lambda job: len(job[1]), reverse=True)
+
+    if workers > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = list(pool.imap_unordered(_build_graph_save, jobs, chunksize=1))
+    else:
+        results = list(map(_build_graph_save, jobs))
+    index_to_result = {result[0]: result for result in results}
+
+    print(f'{"cluster":>8} {"songs":>8} {"epsilon":>10} {"edges":>10} {"seconds":>8}')
+    for i in range(len(centroids)):
+        _, graph_save, seconds = index_to_result[i]
+        print(f'{i:>8} {len(graph_save.points):>8} {graph_save.epsilon:>10.4f} '
+              f'{len(graph_save.edges):>10} {seconds:>8.2f}')
+
+    return {centroids[i]: index_to_result[i][1] for i in range(len(centroids))}
+
+
+def _build_graph_save(job: tuple) -> tuple:
+    """
+    Helper function for build_graph_saves, possibly run in a worker process.
+    Return a tuple (index, Graph_Save, build time in seconds) for the graph of a single
+    cluster.
+    """
+    index, points, epsilon, target_degree, graph_options = job
+    start = time.perf_counter()
+    if target_degree is not None:
+        epsilon = calibrate_epsilon(points, target_degree, fallback=epsilon)
+    graph = Graph(points=points, epsilon=epsilon, **graph_options)
+    graph.init_edges()
+    graph_save = Graph_Save()
+    graph_save.save(graph)
+    return index, graph_save, time.perf_counter() - start
+
+
+def calibrate_epsilon(points: List[Point], target_degree: float,
+                      sample_size: int = DEFAULT_CALIBRATION_SAMPLE,
+                      fallback: float = -1) -> float:
+    """
+    Return an epsilon for which the points have about target_degree neighbours within
+    epsilon on average, or fallback if there are no two points to measure a distance
+    between (e.g. an empty or single song cluster).
+
+    The distances from (at most) sample_size random points to every other point are
+    computed, and epsilon is the distance at which the sampled points have
+    target_degree neighbours on average, i.e. the (target_degree * number sampled)-th
+    smallest of those distances.
+
+    Preconditions:
+        - target_degree > 0
+        - sample_size > 0
+    """
+    if len(points) < 2:
+        return fallback
+    positions = np.array([point.pos for point in points], dtype=np.float64)
+    sample = random.sample(range(len(points)), min(sample_size, len(points)))
+    squared_norms = np.einsum('ij,ij->i', positions, positions)
+    squared = squared_norms[sample][:, None] + squared_norms[None, :] - \
+        2 * (positions[sample] @ positions.T)
+    distances = np.sqrt(np.maximum(squared, 0))
+    # Drop each sampled point's distance to itself
+    distances[np.arange(len(sample)), sample] = np.inf
+    distances = distances[np.isfinite(distances)]
+    if len(distances) == 0:
+        return fallback
+
+    rank = min(int(round(target_degree * len(sample))), len(distances)) - 1
+    return float(np.partition(distances, max(rank, 0))[max(rank, 0)])
+
+
+def tiled_epsilon_pairs(positions: np.ndarray, radius: float,
+                        tile_size: int = DEFAULT_TILE_SIZE,
+                        max_tile_bytes: int = DEFAULT_MAX_TILE_BYTES) -> Iterator[np.ndarray]:
+    """
+    Yield, one tile at a time, (m x 2) arrays of the index pairs [i, j], i < j, of the rows
+    of positions within radius of each other.
+
+    The squared distances of a tile of rows against another are computed in place as
+    ||a||^2 + ||b||^2 - 2 a.b, a single matrix product. Only tiles on or above the diagonal
+    are computed, one at a time, so the full n x n matrix is never built. The tile size is
+    shrunk if needed so that searching a tile never takes more than max_tile_bytes
+    (TILE_ENTRY_BYTES per entry, the worst case being every pair of the tile close).
+    The expansion loses a little precision, so pairs slightly beyond radius may be yielded
+    too.
+
+    Preconditions:
+        - tile_size > 0
+        - max_tile_bytes >= TILE_ENTRY_BYTES
+    """
+    tile_size = max(1, min(tile_size, math.isqrt(max_tile_bytes // TILE_ENTRY_BYTES)))
+    squared_norms = np.einsum('ij,ij->i', positions, positions)
+    threshold = (radius * (1 + 1e-6)) ** 2
+
+    for start in range(0, len(positions), tile_size):
+        rows = positions[start:start + tile_size]
+        for other_start in range(start, len(positions), tile_size):
+            other_rows = positions[other_start:other_start + tile_size]
+            squared = rows @ other_rows.T
+            squared *= -2
+            squared += squared_norms[start:start + tile_size, None]
+            squared += squared_norms[None, other_start:other_start + tile_size]
+            if other_start == start:
+                # Only keep pairs i < j of a tile on the diagonal
+                for i in range(len(rows)):
+                    squared[i, :i + 1] = np.inf
+            close = squared <= threshold
+            del squared
+
+            flat = np.flatnonzero(close)
+            del close
+            pairs = np.empty((len(flat), 2), dtype=np.int64)
+            np.floor_divide(flat, len(other_rows), out=pairs[:, 0])
+            np.remainder(flat, len(other_rows), out=pairs[:, 1])
+            del flat
+            pairs[:, 0] += start
+            pairs[:, 1] += other_start
+            yield pairs
+
+
+def _grid_pairs(positions: np.ndarray, radius: float,
+                max_block_bytes: int = DEFAULT_MAX_TILE_BYTES) -> np.ndarray:
+    """
+    Return the int64 array of the index pairs [i, j], i < j, of the rows of positions within
+    radius of each other, one row per pair, using a uniform grid (cell list).
+
+    The rows are hashed into cells of side radius over the GRID_DIMENSIONS dimensions with the
+    largest spread, so two rows within radius are always in the same or neighbouring cells.
+    Only those cells are compared, on the full distance. Two cells are compared in blocks of
+    rows small enough that comparing a block never takes more than max_block_bytes
+    (GRID_ENTRY_BYTES per pair of rows), however many rows share a cell.
+
+    Preconditions:
+        - radius > 0
+        - max_block_bytes >= GRID_ENTRY_BYTES
+    """
+    block_size = max(1, math.isqrt(max_block_bytes // GRID_ENTRY_BYTES))
+    dimensions = np.argsort(positions.var(axis=0))[::-1][:GRID_DIMENSIONS]
+    cell_of_row = np.floor(positions[:, dimensions] / radius).astype(np.int64)
+    cells = {}
+    for row, cell in enumerate(map(tuple, cell_of_row.tolist())):
+        cells.setdefault(cell, []).append(row)
+    cells = {cell: np.array(rows, dtype=np.int64) for cell, rows in cells.items()}
+    offsets = list(itertools.product((-1, 0, 1), repeat=len(dimensions)))
+
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    for cell, rows in cells.items():
+        for offset in offsets:
+            other_cell = tuple(c + o for c, o in zip(cell, offset))
+            # Compare each pair of cells once (from the smaller cell)
+            if other_cell < cell or other_cell not in cells:
+                continue
+            other_rows = cells[other_cell]
+            for start in range(0, len(rows), block_size):
+                block = rows[start:start + block_size]
+                # Blocks of a cell against itself only need the blocks from the diagonal on
+                other_start = start if other_cell == cell else 0
+                for other_block_start in range(other_start, len(other_rows), block_size):
+                    other_block = other_rows[other_block_start:other_block_start + block_size]
+                    pairs.append(_block_pairs(positions, block, other_block, radius,
+                                              other_cell == cell))
+
+    pairs = np.concatenate(pairs)
+    return np.stack((pairs.min(axis=1), pairs.max(axis=1)), axis=1)
+
+
+def _block_pairs(positions: np.ndarray, rows: np.ndarray, other_rows: np.ndarray,
+                 radius: float, same_cell: bool) -> np.ndarray:
+    """
+    Helper function for _grid_pairs.
+    Return the int64 array of the pairs [i, j], i in rows and j in other_rows, of rows of
+    positions within radius of each other, one row per pair. If same_cell, rows and
+    other_rows are (increasing) rows of one cell and only pairs with i < j are returned.
+    """
+    squared = np.zeros((len(rows), len(other_rows)), dtype=np.float64)
+    for dimension in range(positions.shape[1]):
+        delta = np.subtract.outer(positions[rows, dimension], positions[other_rows, dimension])
+        delta *= delta
+        squared += delta
+        del delta
+    close = squared <= radius * radius
+    del squared
+    if same_cell:
+        close &= rows[:, None] < other_rows[None, :]
+    i, j = np.nonzero(close)
+    return np.stack((rows[i], other_rows[j]), axis=1)
 
 
 def generate_id(size=16,
@@ -445,8 +1374,10 @@ if __name__ == '__main__':
         'extra-imports': ['pickle', 'tkinter', 'PIL', 'urllib', 'webbrowser',
                           'Recommendation', 'Spotify.Spotify_client', 'Spotify.song_features',
                           'k_means', 'spotipy', 'argparse', 'song_tkinter', 'preprocess',
-                          'post_cluster'],
-        'allowed-io': [],
+                          'post_cluster', 'numpy', 'scipy.spatial', 'itertools',
+                          'math', 'multiprocessing', 'time', 'graph_artifact',
+                          'scipy.sparse'],
+        'allowed-io': ['build_graph_saves'],
         # the names (strs) of functions that call print/open/input
         'max-line-length': 100,
         'disable': ['E1136']
@@ -463,7 +1394,22 @@ if __name__ == '__main__':
     arg_parser.add_argument('--epsilon', type=float)
     arg_parser.add_argument('--input-kmeans-clusters-file-name', type=str)
     arg_parser.add_argument('--output-graphs-file-name', type=str)
+    arg_parser.add_argument('--neighbour-search', type=str, default='kd-tree',
+                            choices=NEIGHBOUR_SEARCHES)
+    arg_parser.add_argument('--tile-size', type=int, default=DEFAULT_TILE_SIZE)
+    arg_parser.add_argument('--max-tile-bytes', type=int, default=DEFAULT_MAX_TILE_BYTES)
+    arg_parser.add_argument('--workers', type=int, default=1)
+    arg_parser.add_argument('--k-nearest', type=int, default=None)
+    arg_parser.add_argument('--mutual', action='store_true')
+    arg_parser.add_argument('--target-degree', type=float, default=None)
+    arg_parser.add_argument('--output-artifact-name', type=str, default=None)
     args = arg_parser.parse_args()
+    if args.epsilon is None:
+        if args.k_nearest is None and args.target_degree is None:
+            arg_parser.error('--epsilon is required unless --k-nearest or --target-degree is '
+                             'given')
+        # No cap on the length of an edge in k_nearest mode
+        args.epsilon = -1
 
     # Restore kmeans
     kmeans_cluster_file = open(args.input_kmeans_clusters_file_name, 'rb')
@@ -472,20 +1418,24 @@ if __name__ == '__main__':
     # Create Graphs from clusters
     # Initialize edges for each Graph
     # Map centroid to Graph_Save
-    centroid_to_graph_save = dict()
-    for centroid in centroid_to_cluster:
-        cur_cluster = centroid_to_cluster[centroid]
-        cur_graph = Graph(points=cur_cluster, epsilon=args.epsilon)
-        cur_graph.init_edges()
-        cur_graph_save = Graph_Save()
-        cur_graph_save.save(cur_graph)
-        centroid_to_graph_save[centroid] = cur_graph_save
+    centroid_to_graph_save = build_graph_saves(centroid_to_cluster, args.epsilon,
+                                               workers=args.workers,
+                                               target_degree=args.target_degree,
+                                               neighbour_search=args.neighbour_search,
+                                               tile_size=args.tile_size,
+                                               max_tile_bytes=args.max_tile_bytes,
+                                               k_nearest=args.k_nearest, mutual=args.mutual)
 
     # Pickle centroid_to_graph_save
     save_file = open(args.output_graphs_file_name, 'wb')
     pickle.dump(obj=centroid_to_graph_save, file=save_file, protocol=pickle.HIGHEST_PROTOCOL)
     save_file.close()
 
+    # Also save them as a graph artifact, which main.py restores much faster
+    if args.output_artifact_name is not None:
+        from graph_artifact import write_graph_artifact
+        write_graph_artifact(args.output_artifact_name, centroid_to_graph_save)
+
     # Dev only, for testing purposes!
     """
     # Get a cluster (From kmeans or randomly generate)